@@ -21,12 +21,37 @@
 
 import logging
 import os
+import re
+import shutil
+import subprocess
+import time
+from contextlib import ExitStack
 from pathlib import Path
-
-import gradio as gr
-
-from decode import decode
-from model import get_pretrained_model, get_vad, language_to_models, get_punct_model
+from typing import Optional
+
+from cache import (
+    PcmCache,
+    SpeechCache,
+    TranscriptCache,
+    default_cache_dir,
+)
+from decode import SegmentStore, decode_segments, probe_duration, write_srt
+from jobs import Job, JobQueue, JobQueueFull
+from live import LiveTranscriber, to_pcm
+from metrics import metrics, start_server
+from model import (
+    default_pool_size,
+    get_punct_worker,
+    get_quantization,
+    get_recognizer_pool,
+    language_to_models,
+    model_cache,
+    model_catalog,
+    preload,
+    supports_punctuation,
+    vad_pool,
+)
+from registry import file_digest
 
 title = "# Next-gen Kaldi: Generate subtitles for videos"
 
@@ -49,6 +74,28 @@ If you want to deploy it locally, please see
 <https://k2-fsa.github.io/sherpa/>
 """
 
+transcript_cache = TranscriptCache()
+speech_cache = SpeechCache()
+
+# Decoded audio of the inputs, so a VAD pass after the speech cache entry
+# has been evicted reads it with np.memmap instead of running ffmpeg
+pcm_cache = PcmCache() if os.environ.get("SUBTITLES_PCM_CACHE") == "1" else None
+
+# Files uploaded through the API
+upload_root = Path(default_cache_dir) / "uploads"
+
+
+def _remove_upload(job: Job) -> None:
+    # Called once a finished job is forgotten
+    upload_dir = Path(job.filename).parent
+    if upload_dir.parent == upload_root:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+
+
+# One job per recognizer instance in the pool; UI and API requests only
+# wait for their job, so they do not hold a decoding slot
+job_queue = JobQueue(num_workers=default_pool_size, on_forget=_remove_upload)
+
 # css style is copied from
 # https://huggingface.co/spaces/alphacep/asr/blob/main/app.py#L113
 css = """
@@ -60,6 +107,8 @@ css = """
 
 
 def update_model_dropdown(language: str):
+    import gradio as gr
+
     if language in language_to_models:
         choices = language_to_models[language]
         return gr.Dropdown(
@@ -83,7 +132,16 @@ def build_html_output(s: str, style: str = "result_item_success"):
 
 def show_file_info(in_filename: str):
     logging.info(f"Input file: {in_filename}")
-    _ = os.system(f"ffprobe -hide_banner -i '{in_filename}'")
+    # no shell: in_filename may come from a client
+    subprocess.run(["ffprobe", "-hide_banner", "-i", in_filename])
+
+
+def _input_missing():
+    return build_html_output(
+        "Please first upload a file and then click "
+        'the button "submit for recognition"',
+        "result_item_error",
+    )
 
 
 def process_uploaded_video_file(
@@ -93,21 +151,14 @@ def process_uploaded_video_file(
     in_filename: str,
 ):
     if in_filename is None or in_filename == "":
-        return (
-            "",
-            build_html_output(
-                "Please first upload a file and then click "
-                'the button "submit for recognition"',
-                "result_item_error",
-            ),
-            "",
-            "",
-        )
+        yield None, None, _input_missing(), "", ""
+        return
 
     logging.info(f"Processing uploaded video file: {in_filename}")
 
-    ans = process(language, repo_id, add_punctuation, in_filename)
-    return (in_filename, ans[0]), ans[0], ans[1], ans[2], ans[3]
+    for ans in process(language, repo_id, add_punctuation, in_filename):
+        video = (in_filename, ans[0]) if ans[0] else None
+        yield video, ans[0], ans[1], ans[2], ans[3]
 
 
 def process_uploaded_audio_file(
@@ -117,169 +168,501 @@ def process_uploaded_audio_file(
     in_filename: str,
 ):
     if in_filename is None or in_filename == "":
-        return (
-            "",
-            build_html_output(
-                "Please first upload a file and then click "
-                'the button "submit for recognition"',
-                "result_item_error",
-            ),
-            "",
-            "",
-        )
+        yield None, _input_missing(), "", ""
+        return
 
     logging.info(f"Processing uploaded audio file: {in_filename}")
 
-    return process(language, repo_id, add_punctuation, in_filename)
+    yield from process(language, repo_id, add_punctuation, in_filename)
 
 
-def process(language: str, repo_id: str, add_punctuation: str, in_filename: str):
-    logging.info(f"add_punctuation: {add_punctuation}")
-    recognizer = get_pretrained_model(repo_id)
-    vad = get_vad()
-
-    if (
-        "whisper" in repo_id
-        or "korean" in repo_id
-        or "vosk-model" in repo_id
-        or "asr-gigaspeech2-th-zipformer" in repo_id
-    ):
-        add_punctuation = "No"
+def transcribe_job(job: Job, repo_id: str, add_punctuation: bool) -> dict:
+    """Job function: write the SRT file of job.filename.
+
+    Returns the names of the SRT file and of a text file with the full
+    text. Finished jobs are kept for a while, so the texts themselves are
+    not held in memory.
+    """
+    in_filename = job.filename
+    job.duration = probe_duration(in_filename)
 
-    if add_punctuation == "Yes":
-        punct = get_punct_model()
+    if add_punctuation and supports_punctuation(repo_id):
+        punct = get_punct_worker()
     else:
         punct = None
 
-    result, all_text = decode(recognizer, vad, punct, in_filename)
-    logging.info(result)
-
-    srt_filename = Path(in_filename).with_suffix(".srt")
-    with open(srt_filename, "w", encoding="utf-8") as f:
-        f.write(result)
+    logging.info("Started!")
+
+    # Punctuation is added after the cache lookup, so toggling it
+    # reuses the cached transcript
+    digest = file_digest(in_filename)
+    cache_key = transcript_cache.key(digest, repo_id, get_quantization(repo_id))
+    segments = transcript_cache.get(cache_key)
+    with ExitStack() as stack:
+        times = stack.enter_context(metrics.request("process", job.times))
+        if segments is None:
+            # Each job checks out its own recognizer instance
+            recognizer = stack.enter_context(get_recognizer_pool(repo_id).acquire())
+
+            # The VAD output does not depend on the model, so switching
+            # models on the same file skips ffmpeg and the VAD
+            speech_key = speech_cache.key(digest)
+            speech = speech_cache.get(speech_key)
+            if speech is None:
+                vad = stack.enter_context(vad_pool.acquire())
+                pcm = None
+                if pcm_cache is not None:
+                    start = time.perf_counter()
+                    pcm = pcm_cache.load(pcm_cache.key(digest), in_filename)
+                    times.read += time.perf_counter() - start
+                segments = decode_segments(
+                    recognizer,
+                    vad,
+                    None,
+                    in_filename,
+                    speech_recorder=speech_cache.recorder(speech_key),
+                    pcm=pcm,
+                    times=times,
+                )
+            else:
+                segments = decode_segments(
+                    recognizer, None, None, in_filename, speech=speech, times=times
+                )
+
+            # Closed before the VAD and the recognizer go back to their
+            # pools, also if writing the SRT file fails, so the pipeline's
+            # threads have stopped using them
+            stack.callback(segments.close)
+            segments = transcript_cache.record(cache_key, segments)
+            stack.callback(segments.close)
+
+        def track(segments):
+            for seg in segments:
+                job.add_segment(seg)
+                yield seg
+
+        if isinstance(segments, SegmentStore):
+            # A cache hit; without punctuation, write_srt() formats all
+            # cues at once
+            job.num_segments = len(segments)
+        else:
+            segments = track(segments)
+
+        # Cues are written to the SRT file as soon as they are decoded
+        srt_filename = Path(in_filename).with_suffix(".srt")
+        with open(srt_filename, "w", encoding="utf-8") as f:
+            all_text = write_srt(segments, punct, f, times=times)
+
+    text_filename = Path(in_filename).with_suffix(".txt")
+    with open(text_filename, "w", encoding="utf-8") as f:
+        f.write(all_text)
 
     show_file_info(in_filename)
-    logging.info(f"all_text:\n{all_text}")
+    logging.info(f"{job.num_segments} segments, {len(all_text)} characters")
     logging.info("Done")
 
-    return (
-        str(srt_filename),
+    return {"srt_filename": str(srt_filename), "text_filename": str(text_filename)}
+
+
+def process(language: str, repo_id: str, add_punctuation: str, in_filename: str):
+    """Run in_filename as a job and yield the UI outputs while it runs."""
+    logging.info(f"add_punctuation: {add_punctuation}")
+
+    try:
+        job = job_queue.submit(
+            transcribe_job, in_filename, repo_id, add_punctuation == "Yes"
+        )
+    except JobQueueFull:
+        yield (
+            "",
+            build_html_output(
+                "The server is busy. Please try again later", "result_item_error"
+            ),
+            "",
+            "",
+        )
+        return
+
+    for state in job_queue.watch(job):
+        if not job.done:
+            yield (
+                "",
+                build_html_output(
+                    f"{state['status'].capitalize()}: "
+                    f"{state['progress'] * 100:.0f}%, "
+                    f"{state['num_segments']} segments so far",
+                    "result_item_success",
+                ),
+                "",
+                "",
+            )
+
+    if job.status == "failed":
+        yield "", build_html_output(job.error, "result_item_error"), "", ""
+        return
+
+    with open(job.result["srt_filename"], encoding="utf-8") as f:
+        srt = f.read()
+    with open(job.result["text_filename"], encoding="utf-8") as f:
+        text = f.read()
+    yield (
+        job.result["srt_filename"],
         build_html_output("Done! Please download the SRT file", "result_item_success"),
-        result,
-        all_text,
+        srt,
+        text,
     )
 
 
-demo = gr.Blocks(css=css)
+def _live_text(state: dict) -> str:
+    lines = list(state["finals"])
+    if state["partial"]:
+        lines.append(f"{state['partial']} ...")
+    return "\n".join(lines)
 
 
-with demo:
-    gr.Markdown(title)
-    language_choices = list(language_to_models.keys())
+def _live_update(state: dict, cues) -> None:
+    for cue in cues:
+        if cue.final:
+            state["finals"].append(cue.segment.text)
+            state["partial"] = ""
+        else:
+            state["partial"] = cue.segment.text
 
-    language_radio = gr.Radio(
-        label="Language",
-        choices=language_choices,
-        value=language_choices[0],
-    )
 
-    model_dropdown = gr.Dropdown(
-        choices=language_to_models[language_choices[0]],
-        label="Select a model",
-        value=language_to_models[language_choices[0]][0],
-    )
+def process_microphone(
+    repo_id: str, add_punctuation: str, audio, state: Optional[dict]
+):
+    """Stream handler: caption the microphone audio received so far."""
+    if audio is None:
+        return state, "" if state is None else _live_text(state)
 
-    language_radio.change(
-        update_model_dropdown,
-        inputs=language_radio,
-        outputs=model_dropdown,
-    )
-    punct_radio = gr.Radio(
-        label="Whether to add punctuation",
-        choices=["Yes", "No"],
-        value="Yes",
-    )
+    if state is None or state["repo_id"] != repo_id:
+        if state is not None:
+            state["session"].close()
+        punct = None
+        if add_punctuation == "Yes" and supports_punctuation(repo_id):
+            punct = get_punct_worker()
+        # Each session checks out its own VAD, which keeps state between
+        # chunks, until it stops; a recognizer is only checked out while a
+        # chunk is decoded
+        session = ExitStack()
+        vad = session.enter_context(vad_pool.acquire())
+        state = {
+            "repo_id": repo_id,
+            "session": session,
+            "transcriber": LiveTranscriber(vad, punct),
+            "finals": [],
+            "partial": "",
+        }
+
+    rate, samples = audio
+    with get_recognizer_pool(repo_id).acquire() as recognizer:
+        cues = state["transcriber"].accept(recognizer, to_pcm(rate, samples))
+    _live_update(state, cues)
+    return state, _live_text(state)
+
+
+def stop_microphone(state: Optional[dict]):
+    """Close the last segment when recording stops."""
+    if state is None:
+        return None, ""
+    transcriber = state["transcriber"]
+    with state["session"]:
+        with get_recognizer_pool(state["repo_id"]).acquire() as recognizer:
+            _live_update(state, transcriber.finish(recognizer))
+    logging.info(f"Microphone latency: {transcriber.latency_percentiles()}")
+    # the next recording starts a new session
+    return None, _live_text(state)
+
+
+def build_api():
+    """REST API for jobs, to be served next to the Gradio UI.
+
+    POST /jobs             multipart form with file, repo_id and, optionally,
+                           punctuation=yes|no; returns {"id": ...}, or 429
+                           when the queue is full
+    GET /jobs/{id}         status and progress
+    GET /jobs/{id}/events  the same as server-sent events until it finishes
+    GET /jobs/{id}/srt     the SRT file of a finished job
+    """
+    import json
+    import tempfile
 
-    with gr.Tabs():
-        with gr.TabItem("Upload video from disk"):
-            uploaded_video_file = gr.Video(
-                sources=["upload"],
-                label="Upload from disk",
-                show_share_button=True,
-            )
-            upload_video_button = gr.Button("Submit for recognition")
+    from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+    from fastapi.responses import FileResponse, StreamingResponse
+
+    api = FastAPI()
+
+    def get_job(job_id: str) -> Job:
+        job = job_queue.get(job_id)
+        if job is None:
+            raise HTTPException(404, f"No such job: {job_id}")
+        return job
 
-            output_video = gr.Video(label="Output")
-            output_srt_file_video = gr.File(
-                label="Generated subtitles", show_label=True
+    @api.post("/jobs", status_code=202)
+    def submit(
+        file: UploadFile = File(...),
+        repo_id: str = Form(...),
+        punctuation: str = Form("yes"),
+    ):
+        if repo_id not in model_catalog:
+            raise HTTPException(400, f"Unsupported repo_id: {repo_id}")
+
+        upload_root.mkdir(parents=True, exist_ok=True)
+        upload_dir = Path(tempfile.mkdtemp(prefix="job-", dir=upload_root))
+        # The client's filename is not used, except for a plain extension
+        suffix = Path(file.filename or "").suffix
+        if not re.fullmatch(r"\.[A-Za-z0-9]{1,8}", suffix):
+            suffix = ""
+        filename = upload_dir / f"input{suffix}"
+        with open(filename, "wb") as f:
+            shutil.copyfileobj(file.file, f)
+
+        try:
+            job = job_queue.submit(
+                transcribe_job, str(filename), repo_id, punctuation == "yes"
             )
+        except JobQueueFull as e:
+            shutil.rmtree(upload_dir)
+            raise HTTPException(429, str(e))
+        return {"id": job.id}
+
+    @api.get("/jobs/{job_id}")
+    def status(job_id: str):
+        return get_job(job_id).to_dict()
+
+    @api.get("/jobs/{job_id}/events")
+    def events(job_id: str):
+        job = get_job(job_id)
+        stream = (f"data: {json.dumps(state)}\n\n" for state in job_queue.watch(job))
+        return StreamingResponse(stream, media_type="text/event-stream")
+
+    @api.get("/jobs/{job_id}/srt")
+    def srt(job_id: str):
+        job = get_job(job_id)
+        if job.status != "done":
+            raise HTTPException(409, f"Job {job_id} is {job.status}")
+        return FileResponse(job.result["srt_filename"], media_type="text/plain")
+
+    return api
+
+
+def build_demo():
+    """Build the Gradio UI. gradio is only imported here."""
+    import gradio as gr
 
-            output_info_video = gr.HTML(label="Info")
-            output_textbox_video = gr.Textbox(
-                label="Recognized speech from uploaded video file (srt format)"
+    demo = gr.Blocks(css=css)
+
+    with demo:
+        gr.Markdown(title)
+        language_choices = list(language_to_models.keys())
+
+        language_radio = gr.Radio(
+            label="Language",
+            choices=language_choices,
+            value=language_choices[0],
+        )
+
+        model_dropdown = gr.Dropdown(
+            choices=language_to_models[language_choices[0]],
+            label="Select a model",
+            value=language_to_models[language_choices[0]][0],
+        )
+
+        language_radio.change(
+            update_model_dropdown,
+            inputs=language_radio,
+            outputs=model_dropdown,
+        )
+        punct_radio = gr.Radio(
+            label="Whether to add punctuation",
+            choices=["Yes", "No"],
+            value="Yes",
+        )
+
+        with gr.Tabs():
+            with gr.TabItem("Upload video from disk"):
+                uploaded_video_file = gr.Video(
+                    sources=["upload"],
+                    label="Upload from disk",
+                    show_share_button=True,
+                )
+                upload_video_button = gr.Button("Submit for recognition")
+
+                output_video = gr.Video(label="Output")
+                output_srt_file_video = gr.File(
+                    label="Generated subtitles", show_label=True
+                )
+
+                output_info_video = gr.HTML(label="Info")
+                output_textbox_video = gr.Textbox(
+                    label="Recognized speech from uploaded video file (srt format)"
+                )
+                all_output_textbox_video = gr.Textbox(
+                    label="Recognized speech from uploaded video file (all in one)"
+                )
+
+            with gr.TabItem("Upload audio from disk"):
+                uploaded_audio_file = gr.Audio(
+                    sources=["upload"],  # Choose between "microphone", "upload"
+                    type="filepath",
+                    label="Upload audio from disk",
+                )
+                upload_audio_button = gr.Button("Submit for recognition")
+
+                output_srt_file_audio = gr.File(
+                    label="Generated subtitles", show_label=True
+                )
+
+                output_info_audio = gr.HTML(label="Info")
+                output_textbox_audio = gr.Textbox(
+                    label="Recognized speech from uploaded audio file (srt format)"
+                )
+                all_output_textbox_audio = gr.Textbox(
+                    label="Recognized speech from uploaded audio file (all in one)"
+                )
+
+            with gr.TabItem("Microphone"):
+                live_state = gr.State(None)
+                microphone = gr.Audio(
+                    sources=["microphone"],
+                    type="numpy",
+                    streaming=True,
+                    label="Speak into the microphone",
+                )
+                live_textbox = gr.Textbox(
+                    label="Live captions; a partial last line ends with '...'",
+                    lines=10,
+                )
+
+            microphone.stream(
+                process_microphone,
+                inputs=[model_dropdown, punct_radio, microphone, live_state],
+                outputs=[live_state, live_textbox],
             )
-            all_output_textbox_video = gr.Textbox(
-                label="Recognized speech from uploaded video file (all in one)"
+            microphone.stop_recording(
+                stop_microphone,
+                inputs=[live_state],
+                outputs=[live_state, live_textbox],
             )
 
-        with gr.TabItem("Upload audio from disk"):
-            uploaded_audio_file = gr.Audio(
-                sources=["upload"],  # Choose between "microphone", "upload"
-                type="filepath",
-                label="Upload audio from disk",
+            upload_video_button.click(
+                process_uploaded_video_file,
+                inputs=[
+                    language_radio,
+                    model_dropdown,
+                    punct_radio,
+                    uploaded_video_file,
+                ],
+                outputs=[
+                    output_video,
+                    output_srt_file_video,
+                    output_info_video,
+                    output_textbox_video,
+                    all_output_textbox_video,
+                ],
             )
-            upload_audio_button = gr.Button("Submit for recognition")
 
-            output_srt_file_audio = gr.File(
-                label="Generated subtitles", show_label=True
+            upload_audio_button.click(
+                process_uploaded_audio_file,
+                inputs=[
+                    language_radio,
+                    model_dropdown,
+                    punct_radio,
+                    uploaded_audio_file,
+                ],
+                outputs=[
+                    output_srt_file_audio,
+                    output_info_audio,
+                    output_textbox_audio,
+                    all_output_textbox_audio,
+                ],
             )
 
-            output_info_audio = gr.HTML(label="Info")
-            output_textbox_audio = gr.Textbox(
-                label="Recognized speech from uploaded audio file (srt format)"
-            )
-            all_output_textbox_audio = gr.Textbox(
-                label="Recognized speech from uploaded audio file (all in one)"
-            )
+        gr.Markdown(description)
 
-        upload_video_button.click(
-            process_uploaded_video_file,
-            inputs=[
-                language_radio,
-                model_dropdown,
-                punct_radio,
-                uploaded_video_file,
-            ],
-            outputs=[
-                output_video,
-                output_srt_file_video,
-                output_info_video,
-                output_textbox_video,
-                all_output_textbox_video,
-            ],
-        )
+    return demo
 
-        upload_audio_button.click(
-            process_uploaded_audio_file,
-            inputs=[
-                language_radio,
-                model_dropdown,
-                punct_radio,
-                uploaded_audio_file,
-            ],
-            outputs=[
-                output_srt_file_audio,
-                output_info_audio,
-                output_textbox_audio,
-                all_output_textbox_audio,
-            ],
-        )
 
-    gr.Markdown(description)
+def __getattr__(name: str):
+    # app.demo is built on first access, so that importing this module,
+    # e.g., for process(), does not import gradio
+    if name == "demo":
+        global demo
+        demo = build_demo()
+        return demo
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
     formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
 
     logging.basicConfig(format=formatter, level=logging.INFO)
 
-    demo.launch()
+    # Comma-separated repo_ids, or "all", to load and warm up before
+    # accepting requests
+    to_preload = os.environ.get("SUBTITLES_PRELOAD", "")
+    if to_preload == "all":
+        preload(list(model_catalog))
+    elif to_preload:
+        preload(to_preload.split(","))
+
+    caches = [("transcript", transcript_cache), ("speech", speech_cache)]
+    if pcm_cache is not None:
+        caches.append(("pcm", pcm_cache))
+    for name, cache in caches:
+        for field in ("hits", "misses"):
+            metrics.register(
+                f"subtitles_{name}_cache_{field}_total",
+                "counter",
+                f"Lookups in the {name} cache that were {field}",
+                lambda cache=cache, field=field: getattr(cache, field),
+            )
+    metrics.register(
+        "subtitles_model_cache_bytes",
+        "gauge",
+        "Approximate size of the loaded recognizers",
+        lambda: model_cache.nbytes,
+    )
+    metrics.register(
+        "subtitles_model_cache_evictions_total",
+        "counter",
+        "Recognizer pools unloaded to stay within the memory budget",
+        lambda: model_cache.evictions,
+    )
+    metrics.register(
+        "subtitles_jobs_queued",
+        "gauge",
+        "Jobs waiting for a worker",
+        lambda: job_queue.num_queued,
+    )
+    metrics.register(
+        "subtitles_jobs_running",
+        "gauge",
+        "Jobs being decoded",
+        lambda: job_queue.num_running,
+    )
+    metrics.register(
+        "subtitles_punct_windows_queued",
+        "gauge",
+        "Text windows waiting for the punctuation model, over all jobs",
+        # without loading the model if no job has used it yet
+        lambda: get_punct_worker().num_queued
+        if get_punct_worker.cache_info().currsize
+        else 0,
+    )
+    start_server()
+
+    import gradio as gr
+    import uvicorn
+
+    # Decoding is limited by job_queue, so UI requests, which only wait
+    # for their job, are not limited here
+    demo = build_demo()
+    demo.queue(default_concurrency_limit=None)
+    app = gr.mount_gradio_app(build_api(), demo, path="/")
+    uvicorn.run(
+        app,
+        host=os.environ.get("GRADIO_SERVER_NAME", "127.0.0.1"),
+        port=int(os.environ.get("GRADIO_SERVER_PORT", 7860)),
+    )
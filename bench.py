@@ -0,0 +1,911 @@
+#!/usr/bin/env python3
+#
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmarks for the decoding pipeline.
+
+Usage:
+
+    python3 bench.py decode-batch --repo-id whisper-tiny.en ./test.mp4
+    python3 bench.py vad-feed --hours 1
+    python3 bench.py vad-startup
+    python3 bench.py quantization --repo-id whisper-tiny.en ./test.mp4
+
+    # End-to-end RTF of decode.decode() for every model in the local
+    # manifest on synthetic fixtures, as JSON
+    python3 bench.py rtf --output bench.json
+    python3 bench.py rtf --repo-id whisper-tiny.en ./test.mp4
+
+    # Speedup of decode_parallel() over decode() per number of processes
+    python3 bench.py parallel --repo-id whisper-tiny.en --num-processes 1 2 4 8
+
+    # Windowed punctuation vs. one call per segment plus the full text
+    python3 bench.py punct-window ./test.srt
+
+    # Formatting a 100k-cue SRT from Segment lists vs. a SegmentStore
+    python3 bench.py segments --num-cues 100000
+
+    # Fail if importing an entry point is slow or pulls in gradio,
+    # huggingface_hub or sherpa_onnx
+    python3 bench.py import-time
+"""
+
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+import wave
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+from cache import default_cache_dir
+from decode import (
+    Segment,
+    SegmentStore,
+    StageTimes,
+    WindowFeeder,
+    decode,
+    decode_parallel,
+    decode_segments,
+    decode_streams_batched,
+    default_batch_size,
+    default_max_padded_seconds,
+    default_num_asr_workers,
+    find_split_points,
+    join_texts,
+    new_process_pool,
+    probe_duration,
+    punctuate_segments,
+    start_ffmpeg,
+)
+from model import (
+    VadPool,
+    get_pretrained_model,
+    get_punct_model,
+    get_vad,
+    model_catalog,
+    sample_rate,
+    supports_punctuation,
+    warm_up_recognizer,
+)
+from registry import registry
+
+
+def _read_samples(filename: str) -> np.ndarray:
+    process = start_ffmpeg(filename)
+    data = process.stdout.read()
+    process.wait()
+    return np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768
+
+
+def _vad_segments(samples: np.ndarray):
+    vad = get_vad()
+    window_size = 512
+    for i in range(0, len(samples) - window_size + 1, window_size):
+        vad.accept_waveform(samples[i : i + window_size])
+    vad.flush()
+
+    segments = []
+    while not vad.empty():
+        segments.append(np.array(vad.front.samples, dtype=np.float32))
+        vad.pop()
+    return segments
+
+
+def bench_decode_batch(args):
+    # The real pipeline, decode_segments(), with one ASR worker so that
+    # only the batching differs between the runs
+    recognizer = get_pretrained_model(args.repo_id)
+    warm_up_recognizer(recognizer)
+
+    def run(batch_size):
+        times = StageTimes()
+        start = time.perf_counter()
+        segments = list(
+            decode_segments(
+                recognizer,
+                get_vad(),
+                None,
+                args.filename,
+                batch_size=batch_size,
+                max_padded_seconds=args.max_padded_seconds,
+                num_asr_workers=1,
+                times=times,
+            )
+        )
+        return time.perf_counter() - start, times, len(segments)
+
+    for name, batch_size in (("per-stream", 1), ("batched", args.batch_size)):
+        elapsed, times, num_segments = run(batch_size)
+        print(
+            f"{name:>10}: batch_size={batch_size:<3} "
+            f"{elapsed:.3f} s wall, ASR {times.asr:.3f} s, "
+            f"{num_segments / times.asr:.2f} segments/s"
+        )
+
+
+def _legacy_feed(f, frames_per_read: int, window_size: int, accept_waveform):
+    # The VAD feed loop of decode.decode() before WindowFeeder was added
+    buffer = []
+    is_last = False
+    while True:
+        data = f.read(frames_per_read * 2)
+        if not data:
+            if is_last:
+                break
+            is_last = True
+            data = np.zeros(sample_rate, dtype=np.int16)
+
+        samples = np.frombuffer(data, dtype=np.int16)
+        samples = samples.astype(np.float32) / 32768
+
+        buffer = np.concatenate([buffer, samples])
+        while len(buffer) > window_size:
+            accept_waveform(buffer[:window_size])
+            buffer = buffer[window_size:]
+
+
+def _window_feeder_feed(f, frames_per_read: int, window_size: int, accept_waveform):
+    feeder = WindowFeeder(frames_per_read, window_size)
+    is_last = False
+    while True:
+        if feeder.read(f) == 0:
+            if is_last:
+                break
+            is_last = True
+            feeder.append(np.zeros(sample_rate, dtype=np.int16))
+
+        feeder.feed(accept_waveform)
+
+
+def bench_vad_feed(args):
+    num_samples = int(args.hours * 3600 * sample_rate)
+    rng = np.random.default_rng(0)
+    pcm = rng.integers(-32768, 32768, size=num_samples, dtype=np.int16).tobytes()
+    logging.info(f"Synthetic PCM stream: {args.hours} h, {len(pcm) / 1e6:.1f} MB")
+
+    frames_per_read = int(sample_rate * 100)  # 100 second
+    window_size = 512
+
+    for name, feed in (("legacy", _legacy_feed), ("feeder", _window_feeder_feed)):
+        num_windows = 0
+
+        def accept_waveform(samples):
+            nonlocal num_windows
+            num_windows += 1
+
+        start = time.perf_counter()
+        feed(io.BytesIO(pcm), frames_per_read, window_size, accept_waveform)
+        elapsed = time.perf_counter() - start
+
+        # A second pass under tracemalloc, which slows things down and
+        # is therefore not included in the wall time above
+        tracemalloc.start()
+        feed(io.BytesIO(pcm), frames_per_read, window_size, lambda samples: None)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print(
+            f"{name:>8}: {elapsed:.3f} s, {num_windows} windows, "
+            f"peak traced memory {peak / 1e6:.1f} MB"
+        )
+
+
+def bench_vad_startup(args):
+    # What a request did before decoding: resolve the model on the hub
+    # and construct a new VoiceActivityDetector
+    get_vad()  # download the model, if needed
+    start = time.perf_counter()
+    for _ in range(args.num_requests):
+        get_vad()
+    per_request = (time.perf_counter() - start) / args.num_requests
+    print(f" get_vad(): {per_request * 1000:.3f} ms per request")
+
+    pool = VadPool()
+    with pool.acquire():
+        pass
+
+    start = time.perf_counter()
+    for _ in range(args.num_requests):
+        with pool.acquire():
+            pass
+    per_request = (time.perf_counter() - start) / args.num_requests
+    print(f"  VadPool: {per_request * 1000:.3f} ms per request")
+
+
+def _bench_variant(
+    repo_id: str,
+    quantization: str,
+    segments: List[np.ndarray],
+    batch_size: int,
+    max_padded_seconds: float,
+) -> dict:
+    # Runs in a fresh process, so that peak RSS covers a single variant
+    start = time.perf_counter()
+    recognizer = get_pretrained_model(repo_id, quantization=quantization)
+    load_time = time.perf_counter() - start
+
+    warm_up_recognizer(recognizer)
+
+    durations = [len(s) / sample_rate for s in segments]
+    streams = []
+    for samples in segments:
+        s = recognizer.create_stream()
+        s.accept_waveform(sample_rate, samples)
+        streams.append(s)
+
+    start = time.perf_counter()
+    decode_streams_batched(
+        recognizer,
+        streams,
+        durations,
+        batch_size=batch_size,
+        max_padded_seconds=max_padded_seconds,
+    )
+    asr_time = time.perf_counter() - start
+
+    return {
+        "load_time": load_time,
+        "rtf": asr_time / max(sum(durations), 1e-9),
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "text": " ".join(s.result.text.strip() for s in streams),
+    }
+
+
+def bench_quantization(args):
+    variants = model_catalog[args.repo_id].variants
+    if len(variants) == 1:
+        logging.warning(f"{args.repo_id} only has a {variants[0]} variant")
+
+    segments = _vad_segments(_read_samples(args.filename))
+    logging.info(
+        f"{len(segments)} segments, "
+        f"{sum(len(s) for s in segments) / sample_rate:.2f} s of speech"
+    )
+
+    ctx = multiprocessing.get_context("spawn")
+    results = {}
+    for q in variants:
+        # one process per variant; spawn does not inherit loaded models
+        with ctx.Pool(1) as pool:
+            results[q] = pool.apply(
+                _bench_variant,
+                (
+                    args.repo_id,
+                    q,
+                    segments,
+                    args.batch_size,
+                    args.max_padded_seconds,
+                ),
+            )
+
+    for q, r in results.items():
+        print(
+            f"{q:>5}: load {r['load_time']:.3f} s, RTF {r['rtf']:.4f}, "
+            f"peak RSS {r['peak_rss'] / 1e6:.1f} MB"
+        )
+
+    if len(results) > 1:
+        texts = {q: r["text"] for q, r in results.items()}
+        same = len(set(texts.values())) == 1
+        print(f"Transcripts {'match' if same else 'differ'} across variants")
+        if not same:
+            for q, text in texts.items():
+                logging.info(f"{q}: {text}")
+
+
+def make_fixture(filename: str, seconds: float, seed: int = 0) -> None:
+    """Write a 16 kHz mono WAV file of speech-like sound and silence.
+
+    Bursts of 0.5 to 4 seconds of a harmonic tone with a drifting pitch,
+    amplitude-modulated at a syllable rate, alternate with 0.3 to 1.5
+    seconds of near silence, so the VAD finds segments as in real speech.
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = int(seconds * sample_rate)
+    audio = rng.normal(0, 1e-4, num_samples).astype(np.float32)
+
+    t = rng.uniform(0.3, 1.5)
+    while t < seconds - 1:
+        duration = min(rng.uniform(0.5, 4.0), seconds - 1 - t)
+        begin = int(t * sample_rate)
+        n = int(duration * sample_rate)
+        x = np.arange(n) / sample_rate
+
+        f0 = rng.uniform(100, 220) * (1 + 0.1 * np.sin(2 * np.pi * 0.5 * x))
+        phase = 2 * np.pi * np.cumsum(f0) / sample_rate
+        voiced = sum(np.sin(k * phase) / k for k in range(1, 11))
+
+        syllables = 0.5 - 0.5 * np.cos(2 * np.pi * rng.uniform(3, 6) * x)
+        noise = rng.normal(0, 0.05, n)
+        audio[begin : begin + n] += 0.3 * syllables * (voiced / 3 + noise)
+
+        t += duration + rng.uniform(0.3, 1.5)
+
+    samples = (np.clip(audio, -1, 1) * 32767).astype(np.int16)
+    with wave.open(filename, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(samples.tobytes())
+
+
+def _fixtures(fixture_dir: str, lengths: List[float]) -> List[str]:
+    Path(fixture_dir).mkdir(parents=True, exist_ok=True)
+    filenames = []
+    for seconds in lengths:
+        filename = str(Path(fixture_dir) / f"synthetic-{seconds:g}s.wav")
+        if not Path(filename).is_file():
+            logging.info(f"Generating {filename}")
+            make_fixture(filename, seconds)
+        filenames.append(filename)
+    return filenames
+
+
+def _bench_rtf(
+    repo_id: str,
+    filenames: List[str],
+    punctuation: bool,
+    batch_size: int,
+    num_asr_workers: int,
+) -> dict:
+    # Runs in a fresh process, so that peak RSS covers a single model
+    start = time.perf_counter()
+    recognizer = get_pretrained_model(repo_id)
+    load_time = time.perf_counter() - start
+    warm_up_recognizer(recognizer)
+
+    vad = get_vad()
+    # as in the app, only for models whose output has no punctuation
+    if punctuation and supports_punctuation(repo_id):
+        punct = get_punct_model()
+    else:
+        punct = None
+
+    runs = []
+    for filename in filenames:
+        times = StageTimes()
+        start = time.perf_counter()
+        decode(
+            recognizer,
+            vad,
+            punct,
+            filename,
+            batch_size=batch_size,
+            num_asr_workers=num_asr_workers,
+            times=times,
+        )
+        elapsed = time.perf_counter() - start
+        vad.reset()
+
+        audio_seconds = times.num_samples / sample_rate
+        runs.append(
+            {
+                "filename": filename,
+                "audio_seconds": audio_seconds,
+                "wall_seconds": elapsed,
+                "rtf": elapsed / max(audio_seconds, 1e-9),
+                "num_segments": times.num_segments,
+                "segments_per_second": times.num_segments / elapsed,
+                "stages": {
+                    "ffmpeg": times.read,
+                    "vad": times.vad,
+                    "asr": times.asr,
+                    "punctuation": times.punct,
+                    "srt": times.srt,
+                },
+            }
+        )
+
+    return {
+        "repo_id": repo_id,
+        "load_seconds": load_time,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "runs": runs,
+    }
+
+
+def bench_rtf(args):
+    import sherpa_onnx
+
+    repo_ids = args.repo_id
+    if not repo_ids:
+        # only models whose files are already on disk
+        repo_ids = [name for name in registry.models() if name in model_catalog]
+        if not repo_ids:
+            raise SystemExit(
+                "No models in the local manifest. "
+                "Run 'python3 registry.py prefetch' or pass --repo-id"
+            )
+
+    filenames = args.filenames or _fixtures(args.fixture_dir, args.fixture_seconds)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for repo_id in repo_ids:
+        logging.info(f"Benchmarking {repo_id}")
+        # one process per model; spawn does not inherit loaded models
+        with ctx.Pool(1) as pool:
+            try:
+                result = pool.apply(
+                    _bench_rtf,
+                    (
+                        repo_id,
+                        filenames,
+                        args.punctuation,
+                        args.batch_size,
+                        args.num_asr_workers,
+                    ),
+                )
+            except Exception as e:
+                logging.exception(f"Failed to benchmark {repo_id}")
+                result = {"repo_id": repo_id, "error": str(e)}
+        results.append(result)
+
+        for run in result.get("runs", []):
+            stages = ", ".join(f"{k} {v:.3f} s" for k, v in run["stages"].items())
+            logging.info(
+                f"{repo_id} {Path(run['filename']).name}: RTF {run['rtf']:.4f}, "
+                f"{run['segments_per_second']:.2f} segments/s ({stages})"
+            )
+
+    report = {
+        "version": 1,
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": {
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "sherpa_onnx": sherpa_onnx.__version__,
+        },
+        "config": {
+            "punctuation": args.punctuation,
+            "batch_size": args.batch_size,
+            "num_asr_workers": args.num_asr_workers,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+        logging.info(f"Saved to {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if any("error" in r for r in results):
+        raise SystemExit("Some models failed")
+
+
+def _load_in_worker(repo_id: str) -> int:
+    # Loads the recognizer of a decode_parallel() worker before the timed
+    # run; the sleep spreads the calls over all processes of the pool
+    get_pretrained_model(repo_id)
+    time.sleep(1)
+    return os.getpid()
+
+
+def bench_parallel(args):
+    if args.filename:
+        filename = args.filename
+    else:
+        (filename,) = _fixtures(args.fixture_dir, [args.fixture_seconds])
+    audio_seconds = probe_duration(filename)
+
+    recognizer = get_pretrained_model(args.repo_id)
+    warm_up_recognizer(recognizer)
+    start = time.perf_counter()
+    decode(recognizer, get_vad(), None, filename)
+    sequential = time.perf_counter() - start
+    print(
+        f"  decode(): {sequential:.3f} s, "
+        f"RTF {sequential / audio_seconds:.4f}, {os.cpu_count()} CPUs"
+    )
+
+    for n in args.num_processes:
+        with new_process_pool(n) as pool:
+            num_loaded = len(set(pool.map(_load_in_worker, [args.repo_id] * n)))
+
+            start = time.perf_counter()
+            ranges = find_split_points(filename, n * args.ranges_per_worker)
+            split = time.perf_counter() - start
+
+            start = time.perf_counter()
+            decode_parallel(
+                args.repo_id,
+                None,
+                filename,
+                n,
+                ranges_per_worker=args.ranges_per_worker,
+                executor=pool,
+            )
+            elapsed = time.perf_counter() - start
+
+        print(
+            f"{n:>2} processes: {elapsed:.3f} s ({split:.3f} s finding "
+            f"{len(ranges) - 1} split points), RTF {elapsed / audio_seconds:.4f}, "
+            f"speedup {sequential / elapsed:.2f}x"
+            + ("" if num_loaded == n else f", only {num_loaded} warmed up")
+        )
+
+
+def _legacy_punctuate(texts: List[str], punct) -> List[str]:
+    # How decode.write_srt() punctuated before punctuate_segments(): each
+    # segment, then the whole transcript once more
+    cues = [punct.add_punctuation(text) for text in texts]
+    punct.add_punctuation(join_texts(texts))
+    return cues
+
+
+def bench_punct_window(args):
+    with open(args.filename, encoding="utf-8") as f:
+        # the third line on of each cue is its text
+        texts = [
+            " ".join(cue.split("\n")[2:])
+            for cue in f.read().strip().split("\n\n")
+            if cue.count("\n") >= 2
+        ]
+    texts = [text for text in texts if text] * args.repeat
+    logging.info(f"{len(texts)} segments, {sum(map(len, texts))} characters")
+
+    punct = get_punct_model()
+    num_chars = 0
+
+    class Counting:
+        def add_punctuation(self, text):
+            nonlocal num_chars
+            num_chars += len(text)
+            return punct.add_punctuation(text)
+
+    def windowed(texts, punct):
+        segments = [Segment(start=0, duration=0, text=text) for text in texts]
+        return [seg.text for seg in punctuate_segments(segments, punct)]
+
+    punct.add_punctuation("hello world")  # warm up
+    for name, fn in (("legacy", _legacy_punctuate), ("windowed", windowed)):
+        num_chars = 0
+        start = time.perf_counter()
+        fn(texts, Counting())
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>8}: {elapsed:.3f} s, {num_chars} characters through the model"
+        )
+
+
+@dataclass
+class _LegacySegment:
+    # decode.Segment before SegmentStore: a __dict__ per instance, and
+    # timestamps formatted through timedelta
+    start: float
+    duration: float
+    text: str = ""
+
+    @property
+    def end(self):
+        return self.start + self.duration
+
+    def __str__(self):
+        s = f"0{timedelta(seconds=self.start)}"[:-3]
+        s += " --> "
+        s += f"0{timedelta(seconds=self.end)}"[:-3]
+        s = s.replace(".", ",")
+        s += "\n"
+        s += self.text
+        return s
+
+
+def _synthetic_cues(num_cues: int):
+    # Sample-aligned times, as from the VAD; 100k cues are about 80 h
+    rng = np.random.default_rng(0)
+    gaps = rng.integers(sample_rate // 5, sample_rate, num_cues)
+    durations = rng.integers(sample_rate // 2, 4 * sample_rate, num_cues)
+    starts = np.cumsum(gaps) + np.concatenate([[0], np.cumsum(durations)[:-1]])
+    words = ["the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog"]
+    for i in range(num_cues):
+        text = " ".join(words[(i + k) % len(words)] for k in range(3 + i % 9))
+        yield int(starts[i]) / sample_rate, int(durations[i]) / sample_rate, text
+
+
+def bench_segments(args):
+    cues = list(_synthetic_cues(args.num_cues))
+    hours = (cues[-1][0] + cues[-1][1]) / 3600
+    logging.info(f"{len(cues)} cues, {hours:.1f} h")
+
+    def build(kind):
+        if kind == "store":
+            return SegmentStore.from_segments(Segment(*c) for c in cues)
+        cls = _LegacySegment if kind == "legacy" else Segment
+        return [cls(*c) for c in cues]
+
+    def join(segments):
+        return "\n\n".join(f"{i}\n{seg}" for i, seg in enumerate(segments, 1))
+
+    def best_of(fn):
+        # the fastest of a few runs
+        times = []
+        for _ in range(args.num_runs):
+            start = time.perf_counter()
+            result = fn()
+            times.append(time.perf_counter() - start)
+        return min(times), result
+
+    outputs = {}
+    for kind, name, fn in (
+        ("legacy", "dataclass, join", join),
+        ("slots", "__slots__, join", join),
+        ("store", "SegmentStore.to_srt()", SegmentStore.to_srt),
+        ("store", "SegmentStore.to_vtt()", SegmentStore.to_vtt),
+    ):
+        tracemalloc.start()
+        segments = build(kind)
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        elapsed, outputs[name] = best_of(lambda: fn(segments))
+        print(
+            f"{name:>22}: {elapsed * 1000:8.1f} ms to format, "
+            f"{size / 1e6:6.1f} MB for the segments"
+        )
+
+    # The old formatting dropped the milliseconds of whole seconds and
+    # wrote hours >= 10 with three digits; other cues must be the same
+    legacy = outputs["dataclass, join"].split("\n\n")
+    new = outputs["SegmentStore.to_srt()"].split("\n\n")
+    differ = sum(
+        a != b
+        for a, b, (start, duration, _) in zip(legacy, new, cues)
+        if start + duration < 36000
+        and start % 1
+        and (start + duration) % 1
+    )
+    same = outputs["__slots__, join"] == outputs["SegmentStore.to_srt()"]
+    print(
+        f"to_srt() equals the join over Segment: {same}; "
+        f"{differ} cues under 10 h differ from the legacy format"
+    )
+
+
+# Modules that must not be imported by importing the modules below; they
+# are imported on first use instead
+_heavy_modules = ("gradio", "huggingface_hub", "sherpa_onnx")
+
+# Budget for the cumulative import time of each module, in milliseconds.
+# numpy accounts for most of it.
+_import_budgets = {
+    "registry": 100,
+    "decode": 250,
+    "jobs": 250,
+    "model": 300,
+    "cache": 300,
+    "metrics": 350,
+    "transcribe": 350,
+    "live": 350,
+    "app": 400,
+}
+
+
+def _import_time(module: str) -> tuple:
+    """Cumulative import time of module in ms, and the heavy modules it
+    imported, measured in a fresh interpreter with -X importtime."""
+    code = (
+        f"import sys, {module}; "
+        f"print(','.join(m for m in {_heavy_modules!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # lines look like "import time:  self [us] | cumulative | module"
+    match = re.search(
+        rf"^import time:\s+\d+ \|\s+(\d+) \| {module}$",
+        result.stderr,
+        re.MULTILINE,
+    )
+    heavy = [m for m in result.stdout.strip().split(",") if m]
+    return int(match.group(1)) / 1000, heavy
+
+
+def bench_import_time(args):
+    failed = False
+    for module, budget in _import_budgets.items():
+        budget *= args.budget_scale
+        # the fastest of several runs, to ignore a cold file system cache
+        runs = [_import_time(module) for _ in range(args.num_runs)]
+        ms = min(ms for ms, _ in runs)
+        heavy = runs[0][1]
+
+        problems = []
+        if ms > budget:
+            problems.append(f"over budget of {budget:.0f} ms")
+        if heavy:
+            problems.append(f"imports {', '.join(heavy)}")
+        failed = failed or bool(problems)
+
+        print(
+            f"{module:>10}: {ms:7.1f} ms "
+            f"{'; '.join(problems) if problems else 'OK'}"
+        )
+
+    if failed:
+        raise SystemExit("Import time check failed")
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser(
+        "decode-batch",
+        help="Compare per-stream decoding with decode_streams() batches",
+    )
+    p.add_argument("--repo-id", type=str, required=True)
+    p.add_argument("--batch-size", type=int, default=default_batch_size)
+    p.add_argument(
+        "--max-padded-seconds", type=float, default=default_max_padded_seconds
+    )
+    p.add_argument("filename", type=str)
+    p.set_defaults(func=bench_decode_batch)
+
+    p = subparsers.add_parser(
+        "vad-feed",
+        help="Time the PCM -> VAD window loop on a synthetic stream (no model needed)",
+    )
+    p.add_argument("--hours", type=float, default=1.0)
+    p.set_defaults(func=bench_vad_feed)
+
+    p = subparsers.add_parser(
+        "vad-startup",
+        help="Per-request VAD startup latency with and without VadPool",
+    )
+    p.add_argument("--num-requests", type=int, default=20)
+    p.set_defaults(func=bench_vad_startup)
+
+    p = subparsers.add_parser(
+        "quantization",
+        help="Load time, RTF and peak RSS of each quantization variant of a model",
+    )
+    p.add_argument("--repo-id", type=str, required=True)
+    p.add_argument("--batch-size", type=int, default=default_batch_size)
+    p.add_argument(
+        "--max-padded-seconds", type=float, default=default_max_padded_seconds
+    )
+    p.add_argument("filename", type=str)
+    p.set_defaults(func=bench_quantization)
+
+    p = subparsers.add_parser(
+        "rtf",
+        help="Per-stage timings, RTF and peak RSS of decode.decode() per model",
+    )
+    p.add_argument(
+        "--repo-id",
+        type=str,
+        action="append",
+        help="Model to benchmark; may be repeated. "
+        "Default: all models in the local manifest",
+    )
+    p.add_argument(
+        "--fixture-dir",
+        type=str,
+        default=str(Path(default_cache_dir) / "bench"),
+        help="Where synthetic fixtures are generated when no file is given",
+    )
+    p.add_argument(
+        "--fixture-seconds",
+        type=float,
+        nargs="+",
+        default=[60.0, 600.0],
+        help="Lengths of the synthetic fixtures",
+    )
+    p.add_argument(
+        "--punctuation",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Add punctuation, as the app does for most models",
+    )
+    p.add_argument("--batch-size", type=int, default=default_batch_size)
+    p.add_argument(
+        "--num-asr-workers", type=int, default=default_num_asr_workers
+    )
+    p.add_argument("--output", type=str, help="JSON file. Default: stdout")
+    p.add_argument("filenames", type=str, nargs="*", help="Audio or video files")
+    p.set_defaults(func=bench_rtf)
+
+    p = subparsers.add_parser(
+        "parallel",
+        help="Speedup of decode_parallel() per number of worker processes",
+    )
+    p.add_argument("--repo-id", type=str, required=True)
+    p.add_argument(
+        "--num-processes", type=int, nargs="+", default=[1, 2, 4, 8]
+    )
+    p.add_argument("--ranges-per-worker", type=int, default=2)
+    p.add_argument(
+        "--fixture-dir",
+        type=str,
+        default=str(Path(default_cache_dir) / "bench"),
+        help="Where the synthetic fixture is generated when no file is given",
+    )
+    p.add_argument("--fixture-seconds", type=float, default=600.0)
+    p.add_argument("filename", type=str, nargs="?", help="Audio or video file")
+    p.set_defaults(func=bench_parallel)
+
+    p = subparsers.add_parser(
+        "punct-window",
+        help="Windowed punctuation vs. per segment plus full text, on an SRT file",
+    )
+    p.add_argument(
+        "--repeat", type=int, default=1, help="Repeat the cues, for a longer text"
+    )
+    p.add_argument("filename", type=str)
+    p.set_defaults(func=bench_punct_window)
+
+    p = subparsers.add_parser(
+        "segments",
+        help="Format a synthetic SRT from Segment lists and a SegmentStore",
+    )
+    p.add_argument("--num-cues", type=int, default=100000)
+    p.add_argument("--num-runs", type=int, default=3)
+    p.set_defaults(func=bench_segments)
+
+    p = subparsers.add_parser(
+        "import-time",
+        help="Check the import time of each module against its budget",
+    )
+    p.add_argument("--num-runs", type=int, default=5)
+    p.add_argument(
+        "--budget-scale",
+        type=float,
+        default=1.0,
+        help="Multiply all budgets, e.g., for slow machines",
+    )
+    p.set_defaults(func=bench_import_time)
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()
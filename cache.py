@@ -0,0 +1,353 @@
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from decode import Segment, SegmentStore, sample_rate, start_ffmpeg
+
+default_cache_dir = "./cache"
+
+default_max_bytes = 1 << 30  # 1 GB
+
+# Bump when the stored format or the decoding pipeline changes results
+_version = 1
+
+
+class _DiskCache:
+    """Directory of cache entries with LRU eviction by total size.
+
+    An entry consists of one file per suffix in _suffixes, all named after
+    its key. The first suffix is the index file: it is written last, so
+    its presence means the entry is complete, and its modification time
+    is the last use of the entry.
+    """
+
+    _suffixes = (".jsonl",)
+
+    def __init__(self, cache_dir: str, name: str, max_bytes: int):
+        self.cache_dir = Path(cache_dir) / name
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, digest: str, *args, **options) -> str:
+        """Key for the input with registry.file_digest() digest and settings."""
+        h = hashlib.sha256()
+        h.update(f"{_version}\n{digest}\n".encode())
+        h.update(json.dumps([args, options], sort_keys=True).encode())
+        return h.hexdigest()
+
+    def _path(self, key: str, suffix: Optional[str] = None) -> Path:
+        return self.cache_dir / f"{key}{suffix or self._suffixes[0]}"
+
+    def _touch(self, key: str) -> None:
+        os.utime(self._path(key))
+
+    def _mkstemp(self):
+        return tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+
+    def _evict(self) -> None:
+        entries = []
+        for path in self.cache_dir.glob(f"*{self._suffixes[0]}"):
+            key = path.name[: -len(self._suffixes[0])]
+            try:
+                mtime = path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            size = 0
+            for suffix in self._suffixes:
+                try:
+                    size += self._path(key, suffix).stat().st_size
+                except FileNotFoundError:
+                    pass
+            entries.append((mtime, size, key))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for suffix in self._suffixes:
+                try:
+                    self._path(key, suffix).unlink()
+                except FileNotFoundError:
+                    pass
+            total -= size
+            logging.info(f"Evicted {self.cache_dir.name} cache entry: {key}")
+
+
+class TranscriptCache(_DiskCache):
+    """On-disk cache of recognized segments.
+
+    Entries are keyed by the content of the input file, the repo_id of
+    the model and the decoding options. Segments are stored without
+    punctuation, so punctuation can be toggled without decoding again.
+    Each entry is a JSON-lines file with one segment per line; get()
+    loads it into a SegmentStore.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = default_cache_dir,
+        max_bytes: int = default_max_bytes,
+    ):
+        super().__init__(cache_dir, "transcripts", max_bytes)
+
+    def get(self, key: str) -> Optional[SegmentStore]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                segments = SegmentStore.from_segments(
+                    Segment(*json.loads(line)) for line in f
+                )
+            # fails if another thread has evicted the entry meanwhile
+            self._touch(key)
+        except FileNotFoundError:
+            self.misses += 1
+            logging.info(f"Transcript cache miss: {key}")
+            return None
+
+        self.hits += 1
+        logging.info(f"Transcript cache hit: {key} ({len(segments)} segments)")
+        return segments
+
+    def record(self, key: str, segments: Iterable[Segment]) -> Iterator[Segment]:
+        """Pass segments through and store them under key.
+
+        Segments are written to a temporary file as they go by. The entry
+        is only added once the iterator is exhausted, so an interrupted
+        decode leaves nothing behind. Text must not be punctuated yet.
+        """
+        fd, tmp = self._mkstemp()
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for seg in segments:
+                    f.write(json.dumps([seg.start, seg.duration, seg.text]))
+                    f.write("\n")
+                    yield seg
+            os.replace(tmp, self._path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        self._evict()
+
+
+class SpeechCache(_DiskCache):
+    """On-disk cache of the VAD output of an input file.
+
+    The VAD output does not depend on the recognizer, so switching models
+    on the same input only needs the ASR pass. An entry is a raw int16
+    file with the samples of all speech segments and a JSON index with,
+    per segment, its chunk number, start sample and number of samples.
+    Converting float samples in [-1, 1) from int16 back to int16 is
+    exact, so recognition results do not change.
+
+    Pass get() as speech and recorder() as speech_recorder to
+    decode.decode_segments().
+    """
+
+    _suffixes = (".json", ".pcm")
+
+    def __init__(
+        self,
+        cache_dir: str = default_cache_dir,
+        max_bytes: int = default_max_bytes,
+    ):
+        super().__init__(cache_dir, "speech", max_bytes)
+
+        # PCM bytes ffmpeg did not have to produce, and the seconds that
+        # ffmpeg and the VAD took when the entries were recorded
+        self.bytes_saved = 0
+        self.seconds_saved = 0.0
+
+    def get(self, key: str) -> Optional[Iterator[List[Tuple[Segment, np.ndarray]]]]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                index = json.load(f)
+            # both fail if another thread has evicted the entry meanwhile
+            self._touch(key)
+            pcm = self._map(key) if index["segments"] else None
+        except FileNotFoundError:
+            self.misses += 1
+            logging.info(f"Speech cache miss: {key}")
+            return None
+
+        self.hits += 1
+        self.bytes_saved += index["num_samples"] * 2
+        self.seconds_saved += index["seconds"]
+        logging.info(
+            f"Speech cache hit: {key} ({len(index['segments'])} segments). "
+            f"Total: {self.hits} hits, "
+            f"{self.bytes_saved / 1e6:.1f} MB of PCM and "
+            f"{self.seconds_saved:.2f} s of ffmpeg+VAD saved"
+        )
+        return self._read(pcm, index["segments"])
+
+    def _map(self, key: str) -> np.ndarray:
+        return np.memmap(self._path(key, ".pcm"), dtype=np.int16, mode="r")
+
+    def _read(
+        self, pcm: Optional[np.ndarray], index: list
+    ) -> Iterator[List[Tuple[Segment, np.ndarray]]]:
+        if not index:
+            return
+
+        chunk = []
+        offset = 0
+        last = index[0][0]
+        for chunk_id, start, n in index:
+            if chunk_id != last:
+                yield chunk
+                chunk = []
+                last = chunk_id
+
+            seg = Segment(start=start / sample_rate, duration=n / sample_rate)
+            samples = pcm[offset : offset + n].astype(np.float32) / 32768
+            chunk.append((seg, samples))
+            offset += n
+        yield chunk
+
+    def recorder(self, key: str) -> "_SpeechRecorder":
+        return _SpeechRecorder(self, key)
+
+
+class _SpeechRecorder:
+    """Writes the VAD output of one decode into a SpeechCache entry.
+
+    The temporary sample file is only created by the first add() or
+    commit(), so a recorder that is never used leaves nothing behind.
+    """
+
+    def __init__(self, cache: SpeechCache, key: str):
+        self.cache = cache
+        self.key = key
+
+        self._tmp = None
+        self._f = None
+        self._index = []
+        self._num_chunks = 0
+
+    def _open(self):
+        if self._f is None:
+            fd, self._tmp = self.cache._mkstemp()
+            self._f = os.fdopen(fd, "wb")
+        return self._f
+
+    def add(self, items: List[Tuple[Segment, list]]) -> None:
+        f = self._open()
+        for seg, samples in items:
+            if not (isinstance(samples, np.ndarray) and samples.dtype == np.int16):
+                samples = (np.asarray(samples, dtype=np.float32) * 32768).astype(
+                    np.int16
+                )
+            f.write(samples.tobytes())
+            self._index.append(
+                (self._num_chunks, round(seg.start * sample_rate), len(samples))
+            )
+        self._num_chunks += 1
+
+    def commit(self, times) -> None:
+        """Publish the entry. times is the decode.StageTimes of the run."""
+        self._open().close()
+        os.replace(self._tmp, self.cache._path(self.key, ".pcm"))
+
+        index = {
+            "segments": self._index,
+            "num_samples": times.num_samples,
+            "seconds": times.read + times.vad,
+        }
+        fd, tmp = self.cache._mkstemp()
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.cache._path(self.key))
+
+        self.cache._evict()
+
+    def close(self) -> None:
+        if self._f is None:
+            return
+        self._f.close()
+        if os.path.exists(self._tmp):
+            os.remove(self._tmp)
+
+
+class PcmCache(_DiskCache):
+    """On-disk cache of input files decoded to 16 kHz mono int16 samples.
+
+    ffmpeg runs once per input; later runs read the raw samples with
+    np.memmap. Pass the result of load() as pcm to
+    decode.decode_segments().
+    """
+
+    _suffixes = (".pcm",)
+
+    def __init__(
+        self,
+        cache_dir: str = default_cache_dir,
+        max_bytes: int = 8 * default_max_bytes,
+    ):
+        super().__init__(cache_dir, "pcm", max_bytes)
+
+    def load(self, key: str, filename: str) -> np.ndarray:
+        """Samples of filename, decoded with ffmpeg unless cached under key."""
+        path = self._path(key)
+        try:
+            # fails if the entry does not exist or another thread evicts
+            # it before it is mapped
+            self._touch(key)
+            pcm = self._map(path)
+        except FileNotFoundError:
+            pass
+        else:
+            self.hits += 1
+            logging.info(f"PCM cache hit: {key}")
+            return pcm
+
+        self.misses += 1
+        logging.info(f"PCM cache miss: {key}. Decoding {filename}")
+        self._create(path, filename)
+        pcm = self._map(path)
+        # after mapping, as the new entry may itself exceed max_bytes
+        self._evict()
+        return pcm
+
+    @staticmethod
+    def _map(path: Path) -> np.ndarray:
+        if path.stat().st_size == 0:
+            # np.memmap cannot map an empty file
+            return np.zeros(0, dtype=np.int16)
+        return np.memmap(path, dtype=np.int16, mode="r")
+
+    def _create(self, path: Path, filename: str) -> None:
+        process = start_ffmpeg(filename)
+        fd, tmp = self._mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(process.stdout, f, 1 << 20)
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to decode {filename}")
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
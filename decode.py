@@ -14,46 +14,452 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# sherpa_onnx is only needed for type annotations; the recognizer, VAD and
+# punctuation objects are created by model.py
+from __future__ import annotations
+
+import json
 import logging
+import multiprocessing
+import os
+import queue
 import subprocess
-from dataclasses import dataclass
-from datetime import timedelta
-from typing import Optional
+import sys
+import tempfile
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from dataclasses import dataclass, replace
+from typing import (
+    TYPE_CHECKING,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    TextIO,
+    Tuple,
+    Union,
+)
 
 import numpy as np
-import sherpa_onnx
 
-from model import sample_rate
+if TYPE_CHECKING:
+    import sherpa_onnx
 
+# Sample rate of the audio that ffmpeg produces for the VAD and the models
+sample_rate = 16000
 
-@dataclass
+# Segments found in one read chunk are grouped into batches of at most
+# this many streams for OfflineRecognizer.decode_streams()
+default_batch_size = 8
+
+# A batch is closed once (number of streams) x (longest segment) would
+# exceed this many seconds, so short segments are not padded to long ones
+default_max_padded_seconds = 120.0
+
+# Number of threads decoding batches with the recognizer concurrently.
+# The recognizer also uses its own intra-op threads for each batch.
+default_num_asr_workers = 2
+
+# Chunks (100 seconds each) that the VAD may run ahead of the output
+default_max_pending_chunks = 4
+
+# Segment texts are punctuated together in windows of at least this many
+# characters, followed by up to default_punct_context_chars characters
+# of the next segments, which only serve as context
+default_punct_window_chars = 500
+default_punct_context_chars = 60
+
+# Windows of one request that a PunctuationWorker may hold before the
+# request waits for the oldest one
+default_max_pending_punct_windows = 8
+
+# A Checkpoint is saved after every this many seconds of decoded input
+default_checkpoint_interval = 60.0
+
+# Samples per window of the silero VAD
+vad_window_size = 512
+
+# find_split_points() searches this many seconds around each even
+# division of the input for a split point, which goes in the middle of
+# the quietest default_split_span_windows VAD windows (0.32 s)
+default_split_search_seconds = 10.0
+default_split_span_windows = 10
+
+
+def format_timestamp(seconds: float, decimal: str = ",") -> str:
+    """HH:MM:SS,mmm as in SRT; decimal="." gives the WebVTT form.
+
+    Milliseconds are truncated after rounding to microseconds, as with
+    str(timedelta(seconds=seconds)).
+    """
+    ms = round(seconds * 1e6) // 1000
+    h, ms = divmod(ms, 3600_000)
+    m, ms = divmod(ms, 60_000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d}{decimal}{ms:03d}"
+
+
+# format_timestamps() writes fixed-width rows, with two digits for hours
+max_vectorized_seconds = 100 * 3600
+
+# Subtitle formats decode() and decode_parallel() can return
+subtitle_formats = ("srt", "vtt")
+
+
+def format_timestamps(seconds: np.ndarray, decimal: str = ",") -> np.ndarray:
+    """format_timestamp() of every value, as rows of ASCII bytes.
+
+    Returns a uint8 array with one 12-byte row per value. Values must be
+    less than max_vectorized_seconds, so that hours have two digits.
+    """
+    us = np.round(np.asarray(seconds, dtype=np.float64) * 1e6).astype(np.int64)
+    if len(us) and us.max() >= max_vectorized_seconds * 1e6:
+        raise ValueError(f"Timestamps must be less than {max_vectorized_seconds} s")
+    h, ms = np.divmod(us // 1000, 3600_000)
+    m, ms = np.divmod(ms, 60_000)
+    s, ms = np.divmod(ms, 1000)
+
+    hw = 2
+    out = np.empty((len(us), hw + 10), dtype=np.uint8)
+
+    def digits(col: int, values: np.ndarray, n: int) -> None:
+        for k in range(n):
+            out[:, col + n - 1 - k] = ord("0") + values // 10**k % 10
+
+    digits(0, h, hw)
+    out[:, hw] = ord(":")
+    digits(hw + 1, m, 2)
+    out[:, hw + 3] = ord(":")
+    digits(hw + 4, s, 2)
+    out[:, hw + 6] = ord(decimal)
+    digits(hw + 7, ms, 3)
+    return out
+
+
+@dataclass(init=False)
 class Segment:
+    # No per-instance __dict__; long transcripts hold many of these
+    __slots__ = ("start", "duration", "text")
+
     start: float
     duration: float
-    text: str = ""
+    text: str
+
+    def __init__(self, start: float, duration: float, text: str = ""):
+        self.start = start
+        self.duration = duration
+        self.text = text
 
     @property
     def end(self):
         return self.start + self.duration
 
     def __str__(self):
-        s = f"0{timedelta(seconds=self.start)}"[:-3]
-        s += " --> "
-        s += f"0{timedelta(seconds=self.end)}"[:-3]
-        s = s.replace(".", ",")
-        s += "\n"
-        s += self.text
-        return s
+        return (
+            f"{format_timestamp(self.start)} --> {format_timestamp(self.end)}\n"
+            f"{self.text}"
+        )
 
 
-def decode(
+class SegmentView:
+    """Read-only view of one segment of a SegmentStore."""
+
+    __slots__ = ("_store", "_index")
+
+    def __init__(self, store: SegmentStore, index: int):
+        self._store = store
+        self._index = index
+
+    @property
+    def start(self) -> float:
+        return float(self._store.start[self._index])
+
+    @property
+    def duration(self) -> float:
+        return float(self._store.duration[self._index])
+
+    @property
+    def end(self) -> float:
+        return self.start + self.duration
+
+    @property
+    def text(self) -> str:
+        return self._store.text(self._index)
+
+    def __str__(self):
+        return str(Segment(self.start, self.duration, self.text))
+
+    def __repr__(self):
+        return f"SegmentView({self.start!r}, {self.duration!r}, {self.text!r})"
+
+
+class SegmentStore:
+    """Segments in columns: start and duration arrays, and all texts in
+    one string with an array of offsets.
+
+    A few bytes per segment besides the text, instead of an object per
+    segment and per text. store[i] is a SegmentView; iterating yields a
+    new Segment at a time, which the consumer may change, e.g., to add
+    punctuation. to_srt() and to_vtt() format all cues at once.
+    """
+
+    def __init__(
+        self,
+        start: np.ndarray,
+        duration: np.ndarray,
+        texts: str = "",
+        offsets: Optional[np.ndarray] = None,
+    ):
+        self.start = np.asarray(start, dtype=np.float64)
+        self.duration = np.asarray(duration, dtype=np.float64)
+        self._texts = texts
+        if offsets is None:
+            offsets = np.zeros(len(self.start) + 1, dtype=np.int64)
+        self._offsets = np.asarray(offsets, dtype=np.int64)
+        assert len(self.start) == len(self.duration) == len(self._offsets) - 1
+
+    @classmethod
+    def from_segments(cls, segments: Iterable[Segment]) -> SegmentStore:
+        start = array("d")
+        duration = array("d")
+        texts = []
+        for seg in segments:
+            start.append(seg.start)
+            duration.append(seg.duration)
+            texts.append(seg.text)
+
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        np.cumsum([len(t) for t in texts], out=offsets[1:])
+        return cls(
+            np.frombuffer(start, dtype=np.float64),
+            np.frombuffer(duration, dtype=np.float64),
+            "".join(texts),
+            offsets,
+        )
+
+    @property
+    def end(self) -> np.ndarray:
+        return self.start + self.duration
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory use."""
+        return (
+            self.start.nbytes
+            + self.duration.nbytes
+            + self._offsets.nbytes
+            + sys.getsizeof(self._texts)
+        )
+
+    def text(self, i: int) -> str:
+        return self._texts[self._offsets[i] : self._offsets[i + 1]]
+
+    def texts(self) -> List[str]:
+        offsets = self._offsets.tolist()
+        return [self._texts[a:b] for a, b in zip(offsets, offsets[1:])]
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __getitem__(self, i: int) -> SegmentView:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return SegmentView(self, i)
+
+    def __iter__(self) -> Iterator[Segment]:
+        offsets = self._offsets.tolist()
+        for i, (start, duration) in enumerate(
+            zip(self.start.tolist(), self.duration.tolist())
+        ):
+            yield Segment(start, duration, self._texts[offsets[i] : offsets[i + 1]])
+
+    def _cues(self, decimal: str) -> Iterator[Tuple[str, str]]:
+        # (timing line, text) of each cue, with every timestamp formatted
+        # by one format_timestamps() call over the start and end columns
+        n = len(self)
+        texts = self._texts
+        offsets = self._offsets.tolist()
+
+        if n and self.end.max() >= max_vectorized_seconds:
+            for i, (start, end) in enumerate(
+                zip(self.start.tolist(), self.end.tolist())
+            ):
+                yield (
+                    f"{format_timestamp(start, decimal)} --> "
+                    f"{format_timestamp(end, decimal)}",
+                    texts[offsets[i] : offsets[i + 1]],
+                )
+            return
+
+        stamps = format_timestamps(np.concatenate([self.start, self.end]), decimal)
+        arrow = np.frombuffer(b" --> ", dtype=np.uint8)
+        lines = np.hstack(
+            [stamps[:n], np.broadcast_to(arrow, (n, len(arrow))), stamps[n:]]
+        )
+        timing = lines.tobytes().decode("ascii")
+        width = lines.shape[1]
+
+        for i in range(n):
+            yield (
+                timing[i * width : (i + 1) * width],
+                texts[offsets[i] : offsets[i + 1]],
+            )
+
+    def to_srt(self) -> str:
+        """The same text as SrtWriter writes for these segments."""
+        return "\n\n".join(
+            f"{i}\n{timing}\n{text}"
+            for i, (timing, text) in enumerate(self._cues(","), start=1)
+        )
+
+    def to_vtt(self) -> str:
+        """The segments as a WebVTT file."""
+        cues = "".join(
+            f"\n\n{timing}\n{text}" for timing, text in self._cues(".")
+        )
+        return f"WEBVTT{cues}\n"
+
+
+class WindowFeeder:
+    """Feed int16 PCM read from a pipe to the VAD in fixed-size windows.
+
+    All buffers are allocated once. Each read lands in a reused bytearray,
+    is converted to float32 into a scratch array that also holds the
+    samples left over from the previous read, and the windows passed to
+    the VAD are views into that scratch array.
+    """
+
+    def __init__(self, frames_per_read: int, window_size: int = 512):
+        self.frames_per_read = frames_per_read
+        self.window_size = window_size
+
+        self._raw = bytearray(frames_per_read * 2)
+        self._raw_samples = np.frombuffer(self._raw, dtype=np.int16)
+
+        # at most window_size samples are carried over between reads
+        self._buffer = np.empty(frames_per_read + window_size, dtype=np.float32)
+        self._num_samples = 0
+
+    def read(self, f) -> int:
+        """Read the next chunk from a binary file object.
+
+        Returns the number of samples read, 0 at end of file.
+        """
+        # *2 because int16_t has two bytes
+        n = (f.readinto(self._raw) or 0) // 2
+        self.append(self._raw_samples[:n])
+        return n
+
+    def append(self, samples: np.ndarray) -> None:
+        """Append int16 samples, converting them to float32 in place."""
+        assert len(samples) <= self.frames_per_read, len(samples)
+
+        start = self._num_samples
+        end = start + len(samples)
+        np.divide(
+            samples,
+            np.float32(32768),
+            out=self._buffer[start:end],
+            dtype=np.float32,
+        )
+        self._num_samples = end
+
+    def feed(self, accept_waveform) -> None:
+        """Pass every complete window to accept_waveform.
+
+        As before, the last window is kept back when the buffered samples
+        divide evenly, so it is passed along with the next read.
+        """
+        window_size = self.window_size
+        buffer = self._buffer
+
+        start = 0
+        while self._num_samples - start > window_size:
+            accept_waveform(buffer[start : start + window_size])
+            start += window_size
+
+        tail = self._num_samples - start
+        if start > 0:
+            buffer[:tail] = buffer[start : self._num_samples]
+        self._num_samples = tail
+
+
+def _make_batches(
+    durations: List[float],
+    batch_size: int,
+    max_padded_seconds: float,
+) -> List[List[int]]:
+    """Group segment indexes into length-bucketed batches.
+
+    Indexes are sorted by duration so that each batch holds segments of
+    similar length. A batch is closed when it has batch_size entries or
+    when padding every entry to the longest one would exceed
+    max_padded_seconds. A single segment always forms a batch on its own.
+    """
+    batches = []
+    current = []
+    for i in sorted(range(len(durations)), key=lambda k: durations[k]):
+        # sorted ascending, so durations[i] is the longest in the batch
+        padded = (len(current) + 1) * durations[i]
+        if current and (len(current) >= batch_size or padded > max_padded_seconds):
+            batches.append(current)
+            current = []
+        current.append(i)
+
+    if current:
+        batches.append(current)
+
+    return batches
+
+
+def decode_streams_batched(
     recognizer: sherpa_onnx.OfflineRecognizer,
-    vad: sherpa_onnx.VoiceActivityDetector,
-    punct: Optional[sherpa_onnx.OfflinePunctuation],
+    streams: List[sherpa_onnx.OfflineStream],
+    durations: List[float],
+    batch_size: int = default_batch_size,
+    max_padded_seconds: float = default_max_padded_seconds,
+) -> None:
+    """Decode streams with recognizer.decode_streams() in length-bucketed batches.
+
+    Results are stored in each stream, so the caller can read them back in
+    the original order.
+    """
+    if batch_size <= 1:
+        for s in streams:
+            recognizer.decode_stream(s)
+        return
+
+    for batch in _make_batches(durations, batch_size, max_padded_seconds):
+        recognizer.decode_streams([streams[i] for i in batch])
+
+
+def start_ffmpeg(
     filename: str,
-) -> str:
-    ffmpeg_cmd = [
-        "ffmpeg",
+    start: Optional[float] = None,
+    duration: Optional[float] = None,
+    realtime: bool = False,
+) -> subprocess.Popen:
+    """Start ffmpeg converting filename to 16 kHz mono s16le on its stdout.
+
+    start and duration (in seconds) select a time range with -ss/-t. With
+    realtime, the input is read at its native pace (-re), as if it were a
+    live stream.
+    """
+    ffmpeg_cmd = ["ffmpeg"]
+    if realtime:
+        ffmpeg_cmd += ["-re"]
+    if start is not None:
+        ffmpeg_cmd += ["-ss", f"{start:.3f}"]
+    if duration is not None:
+        ffmpeg_cmd += ["-t", f"{duration:.3f}"]
+
+    ffmpeg_cmd += [
         "-i",
         filename,
         "-f",
@@ -67,79 +473,1145 @@ def decode(
         "-",
     ]
 
-    process = subprocess.Popen(
+    return subprocess.Popen(
         ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
     )
 
-    frames_per_read = int(sample_rate * 100)  # 100 second
 
-    window_size = 512
+def probe_duration(filename: str) -> Optional[float]:
+    """Length of filename in seconds according to ffprobe, or None."""
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "default=noprint_wrappers=1:nokey=1",
+                filename,
+            ],
+            capture_output=True,
+            text=True,
+        )
+        return float(result.stdout.strip())
+    except (OSError, ValueError):
+        return None
 
-    buffer = []
 
-    segment_list = []
+@dataclass
+class StageTimes:
+    """Work done by each stage of one decode."""
 
-    logging.info("Started!")
+    # seconds spent waiting for ffmpeg output
+    read: float = 0.0
 
-    all_text = []
+    # seconds spent running the VAD
+    vad: float = 0.0
 
-    is_last = False
+    # seconds spent in the recognizer, summed over the ASR workers
+    asr: float = 0.0
 
-    while True:
-        # *2 because int16_t has two bytes
-        data = process.stdout.read(frames_per_read * 2)
-        if not data:
-            if is_last:
+    # seconds spent adding punctuation
+    punct: float = 0.0
+
+    # seconds spent formatting and writing SRT cues
+    srt: float = 0.0
+
+    # samples of input audio read from ffmpeg
+    num_samples: int = 0
+
+    # speech segments found by the VAD
+    num_segments: int = 0
+
+    # most chunks found by the VAD that were waiting for the ASR stage
+    max_pending_chunks: int = 0
+
+
+_stopped = object()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    """Put item into a bounded queue, giving up once stop is set."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """Get an item from a queue. Returns _stopped once stop is set."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _stopped
+
+
+def _read_pcm(
+    process: subprocess.Popen,
+    filename: str,
+    chunks: queue.Queue,
+    free: queue.Queue,
+    stop: threading.Event,
+    times: StageTimes,
+) -> None:
+    """Reader stage: fill reusable byte buffers from the ffmpeg pipe.
+
+    Puts (buffer, num_samples) into chunks, then None at end of file. If
+    ffmpeg fails, an error is put instead of None, so that a truncated
+    decode never looks complete, e.g., to the caches.
+    """
+    f = process.stdout
+    try:
+        while True:
+            raw = _get(free, stop)
+            if raw is _stopped:
+                return
+
+            t = time.perf_counter()
+            # *2 because int16_t has two bytes
+            n = (f.readinto(raw) or 0) // 2
+            times.read += time.perf_counter() - t
+            times.num_samples += n
+            if n == 0:
                 break
-            is_last = True
-            data = np.zeros(sample_rate, dtype=np.int16)
 
-        samples = np.frombuffer(data, dtype=np.int16)
-        samples = samples.astype(np.float32) / 32768
+            if not _put(chunks, (raw, n), stop):
+                return
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed to decode {filename}")
+        _put(chunks, None, stop)
+    except BaseException as e:
+        _put(chunks, e, stop)
 
-        buffer = np.concatenate([buffer, samples])
-        while len(buffer) > window_size:
-            vad.accept_waveform(buffer[:window_size])
-            buffer = buffer[window_size:]
 
-        streams = []
+def _read_memmap(
+    pcm: np.ndarray,
+    frames_per_read: int,
+    chunks: queue.Queue,
+    stop: threading.Event,
+    times: StageTimes,
+) -> None:
+    """Reader stage for decoded audio: put views of pcm into chunks."""
+    for i in range(0, len(pcm), frames_per_read):
+        chunk = pcm[i : i + frames_per_read]
+        times.num_samples += len(chunk)
+        if not _put(chunks, chunk, stop):
+            return
+    _put(chunks, None, stop)
+
+
+def _run_vad(
+    vad: sherpa_onnx.VoiceActivityDetector,
+    feeder: WindowFeeder,
+    chunks: queue.Queue,
+    free: queue.Queue,
+    stop: threading.Event,
+    times: StageTimes,
+    emit,
+    pcm: Optional[np.ndarray] = None,
+) -> bool:
+    """VAD stage: feed PCM chunks to the VAD and emit the segments of each.
+
+    emit() is called once per chunk with a list of (Segment, samples) and
+    returns False if the consumer has gone away. Returns True if the whole
+    input has been processed.
+
+    Chunks are either (buffer, num_samples) from _read_pcm() or int16
+    arrays from _read_memmap(). In the latter case pcm holds all of the
+    input and the samples of each segment are int16 views into it.
+    """
+    while True:
+        item = _get(chunks, stop)
+        if item is _stopped:
+            return False
+        if isinstance(item, BaseException):
+            raise item
+
+        t = time.perf_counter()
+
+        is_last = item is None
+        if is_last:
+            feeder.append(np.zeros(sample_rate, dtype=np.int16))
+        elif isinstance(item, np.ndarray):
+            feeder.append(item)
+        else:
+            raw, n = item
+            feeder.append(np.frombuffer(raw, dtype=np.int16, count=n))
+            free.put(raw)
+
+        feeder.feed(vad.accept_waveform)
+
         segments = []
         while not vad.empty():
+            front = vad.front
+            samples = front.samples
+            n = len(samples)
+            if pcm is not None and front.start + n <= len(pcm):
+                samples = pcm[front.start : front.start + n]
+
             segment = Segment(
-                start=vad.front.start / sample_rate,
-                duration=len(vad.front.samples) / sample_rate,
+                start=front.start / sample_rate,
+                duration=n / sample_rate,
             )
-            segments.append(segment)
+            segments.append((segment, samples))
+            vad.pop()
+        times.vad += time.perf_counter() - t
 
-            stream = recognizer.create_stream()
-            stream.accept_waveform(sample_rate, vad.front.samples)
+        if not emit(segments):
+            return False
 
-            streams.append(stream)
+        if is_last:
+            return True
 
-            vad.pop()
 
-        for s in streams:
-            recognizer.decode_stream(s)
+def _recognize(
+    recognizer: sherpa_onnx.OfflineRecognizer,
+    segments: List[Segment],
+    samples: list,
+) -> float:
+    """ASR stage: decode one batch and store the text in each Segment.
 
-        for seg, stream in zip(segments, streams):
-            seg.text = stream.result.text.strip()
-            if len(seg.text) == 0:
-                logging.info("Skip empty segment")
-                continue
+    samples are float32 in [-1, 1) or, from a memory-mapped input, int16.
+    Returns the seconds it took.
+    """
+    t = time.perf_counter()
+    streams = []
+    for s in samples:
+        if isinstance(s, np.ndarray) and s.dtype == np.int16:
+            s = s.astype(np.float32) / 32768
+        stream = recognizer.create_stream()
+        stream.accept_waveform(sample_rate, s)
+        streams.append(stream)
+
+    # The batch was formed by _make_batches() already, so it is decoded
+    # as a whole
+    decode_streams_batched(
+        recognizer,
+        streams,
+        [seg.duration for seg in segments],
+        batch_size=len(streams),
+        max_padded_seconds=float("inf"),
+    )
+
+    for seg, stream in zip(segments, streams):
+        seg.text = stream.result.text.strip()
+
+    return time.perf_counter() - t
+
+
+def _decode_segments(
+    recognizer: sherpa_onnx.OfflineRecognizer,
+    vad: sherpa_onnx.VoiceActivityDetector,
+    filename: str,
+    batch_size: int,
+    max_padded_seconds: float,
+    num_asr_workers: int,
+    max_pending_chunks: int,
+    start: Optional[float] = None,
+    duration: Optional[float] = None,
+    speech: Optional[Iterable[List[Tuple[Segment, np.ndarray]]]] = None,
+    speech_recorder=None,
+    pcm: Optional[np.ndarray] = None,
+    times: Optional[StageTimes] = None,
+) -> Iterator[Segment]:
+    """Run ffmpeg, VAD and ASR as overlapping stages.
+
+    One thread reads the ffmpeg pipe, one runs the VAD, and a pool of
+    num_asr_workers threads decodes batches of segments. The VAD thread
+    submits each chunk's batches to the pool as soon as they are found;
+    this generator waits for them chunk by chunk, so segments come out
+    in timestamp order. All queues are bounded.
+
+    If start/duration are given, only that range of the input is decoded
+    and segment timestamps are relative to start.
+
+    speech, if given, replaces ffmpeg and the VAD: it yields, per chunk,
+    the (Segment, samples) pairs found by an earlier run. Otherwise
+    speech_recorder.add() receives the VAD output of each chunk and
+    speech_recorder.commit() is called with the StageTimes once the whole
+    input has gone through the VAD; speech_recorder.close() is always
+    called at the end.
+
+    pcm, if given, is the input already decoded to 16 kHz int16 samples,
+    e.g., a np.memmap from cache.PcmCache; it is read instead of running
+    ffmpeg, and segments are sliced from it without copying.
+
+    times, if given, accumulates the time spent in each stage.
+    """
+    process = None
+    if pcm is not None:
+        first = round((start or 0) * sample_rate)
+        last = None if duration is None else first + round(duration * sample_rate)
+        pcm = pcm[first:last]
+    elif speech is None:
+        process = start_ffmpeg(filename, start=start, duration=duration)
+
+    frames_per_read = int(sample_rate * 100)  # 100 second
+
+    feeder = WindowFeeder(frames_per_read, vad_window_size)
+
+    # Two byte buffers let the reader fill one while the VAD consumes the other
+    chunks = queue.Queue(maxsize=1)
+    free = queue.Queue()
+    for _ in range(2):
+        free.put(bytearray(frames_per_read * 2))
+
+    pending = queue.Queue(maxsize=max_pending_chunks)
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(
+        max_workers=num_asr_workers, thread_name_prefix="asr"
+    )
+
+    if times is None:
+        times = StageTimes()
+
+    def emit(items) -> bool:
+        if speech_recorder is not None:
+            speech_recorder.add(items)
 
-            if len(all_text) == 0:
-                all_text.append(seg.text)
-            elif len(all_text[-1][0].encode()) == 1 and len(seg.text[0].encode()) == 1:
-                all_text.append(" ")
-                all_text.append(seg.text)
+        segments = [seg for seg, _ in items]
+        if batch_size <= 1:
+            batches = [[i] for i in range(len(items))]
+        else:
+            batches = _make_batches(
+                [seg.duration for seg in segments], batch_size, max_padded_seconds
+            )
+
+        futures = [
+            executor.submit(
+                _recognize,
+                recognizer,
+                [segments[i] for i in batch],
+                [items[i][1] for i in batch],
+            )
+            for batch in batches
+        ]
+        return _put(pending, (segments, futures), stop)
+
+    def vad_stage():
+        try:
+            if speech is not None:
+                for items in speech:
+                    if not emit(items):
+                        return
+            elif _run_vad(vad, feeder, chunks, free, stop, times, emit, pcm):
+                if speech_recorder is not None:
+                    speech_recorder.commit(times)
+            _put(pending, None, stop)
+        except BaseException as e:
+            _put(pending, e, stop)
+
+    threads = [threading.Thread(target=vad_stage, name="vad", daemon=True)]
+    if pcm is not None and speech is None:
+        threads.append(
+            threading.Thread(
+                target=_read_memmap,
+                args=(pcm, frames_per_read, chunks, stop, times),
+                name="pcm-reader",
+                daemon=True,
+            )
+        )
+    elif process is not None:
+        threads.append(
+            threading.Thread(
+                target=_read_pcm,
+                args=(process, filename, chunks, free, stop, times),
+                name="ffmpeg-reader",
+                daemon=True,
+            )
+        )
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            times.max_pending_chunks = max(
+                times.max_pending_chunks, pending.qsize()
+            )
+            item = pending.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+
+            segments, futures = item
+            for f in futures:
+                times.asr += f.result()
+            times.num_segments += len(segments)
+
+            yield from segments
+    finally:
+        stop.set()
+        if process is not None:
+            process.kill()
+            process.wait()
+        for t in threads:
+            t.join()
+        executor.shutdown(wait=True, cancel_futures=True)
+        if speech_recorder is not None:
+            speech_recorder.close()
+
+
+class Checkpoint:
+    """Progress of one decode, saved to a sidecar JSON file.
+
+    offset is a sample in the middle of a silence, at a VAD window
+    boundary, and segments are all segments before it, as recognized,
+    i.e., without punctuation. A decode resumed from a checkpoint seeks
+    ffmpeg to offset and continues with a fresh VAD, so the VAD windows
+    line up with those of an uninterrupted run.
+
+    key identifies the input and the model; a file saved with another key
+    is ignored. The file is rewritten after every interval seconds of
+    decoded input and when the decode stops.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        key: str,
+        interval: float = default_checkpoint_interval,
+    ):
+        self.filename = filename
+        self.key = key
+        self.interval = interval
+
+        self.offset = 0
+        self.segments: List[Segment] = []
+        self._saved_offset = 0
+
+    def load(self) -> bool:
+        """Read the file, if any. Returns True if there is progress to resume."""
+        try:
+            with open(self.filename, encoding="utf-8") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring checkpoint {self.filename}: {e}")
+            return False
+
+        if state.get("key") != self.key:
+            logging.info(f"Ignoring checkpoint {self.filename} for another input")
+            return False
+
+        self.offset = state["offset"]
+        self.segments = [
+            Segment(start=start, duration=duration, text=text)
+            for start, duration, text in state["segments"]
+        ]
+        self._saved_offset = self.offset
+        return self.offset > 0
+
+    def commit(self, offset: int, segments: List[Segment]) -> None:
+        """segments are done, and offset is the silence after them."""
+        self.segments.extend(segments)
+        self.offset = offset
+        if offset - self._saved_offset >= self.interval * sample_rate:
+            self.save()
+
+    def save(self) -> None:
+        state = {
+            "key": self.key,
+            "offset": self.offset,
+            "segments": [[s.start, s.duration, s.text] for s in self.segments],
+        }
+        dirname = os.path.dirname(self.filename) or "."
+        fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.filename)
+        self._saved_offset = self.offset
+
+    def remove(self) -> None:
+        """Delete the file, once the output has been written."""
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+def _checkpointed(
+    segments: Iterable[Segment], checkpoint: Checkpoint
+) -> Iterator[Segment]:
+    """Yield the saved segments of checkpoint, then the new ones of
+    segments, which start at checkpoint.offset, with absolute timestamps.
+
+    Segments are committed once the next one has started, at the VAD
+    window boundary closest to the middle of the silence in between. The
+    checkpoint keeps copies, since punctuation changes the text of the
+    yielded segments.
+    """
+    # copied first, since commit() appends to checkpoint.segments
+    yield from [replace(seg) for seg in checkpoint.segments]
+
+    w = vad_window_size
+    offset = checkpoint.offset
+    done = []
+    try:
+        for seg in segments:
+            seg.start = (offset + round(seg.start * sample_rate)) / sample_rate
+            if done:
+                prev_end = round(done[-1].end * sample_rate)
+                start = round(seg.start * sample_rate)
+                boundary = round((prev_end + start) / 2 / w) * w
+                if prev_end <= boundary <= start:
+                    checkpoint.commit(boundary, done)
+                    done = []
+            done.append(replace(seg))
+            yield seg
+    finally:
+        checkpoint.save()
+
+
+def _text_separator(prev: str, text: str) -> str:
+    """Separator between two recognized texts in the full transcript.
+
+    Texts starting with single-byte characters (e.g., English words) are
+    separated by a space; CJK texts are concatenated directly.
+    """
+    if not prev or not text:
+        return ""
+    if len(prev[0].encode()) == 1 and len(text[0].encode()) == 1:
+        return " "
+    return ""
+
+
+def _skip_empty(segments: Iterable[Segment]) -> Iterator[Segment]:
+    for seg in segments:
+        if len(seg.text) == 0:
+            logging.info("Skip empty segment")
+            continue
+        yield seg
+
+
+def join_texts(texts: List[str]) -> str:
+    """The full text of segments with texts, see _text_separator().
+
+    Empty texts are skipped, so they do not change the separators.
+    """
+    joined = []
+    for text in texts:
+        if not text:
+            continue
+        if joined:
+            joined.append(_text_separator(joined[-1], text))
+        joined.append(text)
+    return "".join(joined)
+
+
+def _split_punctuated(punctuated: str, texts: List[str]) -> Optional[List[str]]:
+    """Map punctuated, the output for join_texts(texts), back onto texts.
+
+    Characters other than whitespace are matched one by one, ignoring
+    case; whatever the model inserted goes to the text of the preceding
+    character. The model may drop or change the end of the last
+    non-empty text: once one of its characters has matched, the rest of
+    the output goes to it, and it may be dropped altogether. A text that
+    gets no characters keeps its input. Returns None if the output does
+    not match the input before the last text.
+    """
+    source = []  # (character, index into texts)
+    for k, text in enumerate(texts):
+        source.extend((c.lower(), k) for c in text if not c.isspace())
+
+    pieces = [[] for _ in texts]
+    i = 0
+    k = 0
+    num_unmatched = 0  # letters and digits output since the last match
+    for c in punctuated:
+        # punctuation in the input that the model dropped
+        while (
+            i < len(source)
+            and c.lower() != source[i][0]
+            and not source[i][0].isalnum()
+        ):
+            i += 1
+
+        if i < len(source) and c.lower() == source[i][0]:
+            k = source[i][1]
+            i += 1
+            num_unmatched = 0
+        elif c.isalnum():
+            num_unmatched += 1
+        pieces[k].append(c)
+
+    # punctuation at the end of the input that the model dropped
+    while i < len(source) and not source[i][0].isalnum():
+        i += 1
+
+    if i != len(source):
+        last = source[-1][1]
+        if source[i][1] != last:
+            return None
+        if k != last and num_unmatched > 0:
+            # the last text was changed, not dropped
+            return None
+    return [
+        "".join(p).strip() or text for p, text in zip(pieces, texts)
+    ]
+
+
+def _punct_windows(
+    segments: Iterable[Segment], window_chars: int, context_chars: int
+) -> Iterator[Tuple[List[Segment], str]]:
+    """Group segments into windows for punctuation; see punctuate_segments().
+
+    Yields (window, context), where context is the start of the text of
+    the segments after window.
+    """
+
+    def context_of(following: List[Segment]) -> str:
+        context = join_texts([seg.text for seg in following])[:context_chars]
+        if context and len(context) == context_chars and " " in context:
+            # do not end the context in the middle of a word
+            context = context[: context.rindex(" ")]
+        return context
+
+    pending = []
+    num_chars = 0
+    for seg in segments:
+        pending.append(seg)
+        num_chars += len(seg.text)
+        if num_chars < window_chars + context_chars:
+            continue
+
+        n = 0
+        size = 0
+        while size < window_chars:
+            size += len(pending[n].text)
+            n += 1
+        window, pending = pending[:n], pending[n:]
+        num_chars -= size
+        yield window, context_of(pending)
+
+    while pending:
+        n = 0
+        size = 0
+        while n < len(pending) and size < window_chars:
+            size += len(pending[n].text)
+            n += 1
+        window, pending = pending[:n], pending[n:]
+        yield window, context_of(pending)
+
+
+def _punctuate_window(
+    punct: sherpa_onnx.OfflinePunctuation, window: List[Segment], context: str
+) -> None:
+    texts = [seg.text for seg in window]
+    punctuated = punct.add_punctuation(join_texts(texts + [context]))
+    pieces = _split_punctuated(punctuated, texts + [context])
+    if pieces is None:
+        logging.warning("Cannot map punctuation back to segments")
+        pieces = [punct.add_punctuation(text) for text in texts]
+    for seg, text in zip(window, pieces):
+        seg.text = text
+
+
+def punctuate_segments(
+    segments: Iterable[Segment],
+    punct: sherpa_onnx.OfflinePunctuation,
+    times: Optional[StageTimes] = None,
+    window_chars: int = default_punct_window_chars,
+    context_chars: int = default_punct_context_chars,
+) -> Iterator[Segment]:
+    """Add punctuation to the text of each segment, in order.
+
+    Instead of one model call per segment, the texts of consecutive
+    segments are joined into windows of about window_chars characters
+    and punctuated together, with up to context_chars characters of the
+    following segments appended as context. The output is split back at
+    segment boundaries. Each character goes through the model about once,
+    and at most window_chars + context_chars characters, plus one
+    segment, are buffered. Segments must not be empty.
+    """
+    if times is None:
+        times = StageTimes()
+
+    for window, context in _punct_windows(segments, window_chars, context_chars):
+        t = time.perf_counter()
+        _punctuate_window(punct, window, context)
+        times.punct += time.perf_counter() - t
+        yield from window
+
+
+class PunctuationWorker:
+    """Punctuate the segments of all requests on one background thread.
+
+    punctuate() is a drop-in replacement for punctuate_segments(): the
+    calling thread only forms the windows and queues them, and keeps
+    pulling segments from the ASR stage while earlier windows are being
+    punctuated. Windows of all requests go through the model one at a
+    time, in the order they were queued, so a single OfflinePunctuation
+    is never used by two threads at once. Each request gets its segments
+    back in order, with at most max_pending_windows windows in flight.
+    """
+
+    def __init__(
+        self,
+        punct: sherpa_onnx.OfflinePunctuation,
+        max_pending_windows: int = default_max_pending_punct_windows,
+    ):
+        self.punct = punct
+        self.max_pending_windows = max_pending_windows
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start(self) -> None:
+        # Started on first use, so that creating a worker does not start
+        # a thread
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name="punct", daemon=True
+                )
+                self._thread.start()
+
+    @property
+    def num_queued(self) -> int:
+        """Windows waiting for the model, over all requests."""
+        return self._queue.qsize()
+
+    def _work(self) -> None:
+        while True:
+            window, context, future, times = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            t = time.perf_counter()
+            try:
+                _punctuate_window(self.punct, window, context)
+            except Exception as e:
+                future.set_exception(e)
             else:
-                all_text.append(seg.text)
+                future.set_result(None)
+            times.punct += time.perf_counter() - t
+
+    def punctuate(
+        self,
+        segments: Iterable[Segment],
+        times: Optional[StageTimes] = None,
+        window_chars: int = default_punct_window_chars,
+        context_chars: int = default_punct_context_chars,
+    ) -> Iterator[Segment]:
+        """Yield segments with punctuation added, in order.
+
+        See punctuate_segments(); times.punct accumulates the time the
+        worker spent on the windows of this request.
+        """
+        if times is None:
+            times = StageTimes()
+        self._start()
+
+        pending = deque()  # (window, future) in order
+        try:
+            for window, context in _punct_windows(
+                segments, window_chars, context_chars
+            ):
+                future = Future()
+                self._queue.put((window, context, future, times))
+                pending.append((window, future))
+
+                # Hand out what is ready without waiting, unless too many
+                # windows are in flight
+                while pending and (
+                    pending[0][1].done() or len(pending) > self.max_pending_windows
+                ):
+                    window, future = pending.popleft()
+                    future.result()
+                    yield from window
+
+            while pending:
+                window, future = pending.popleft()
+                future.result()
+                yield from window
+        finally:
+            # the consumer stopped early; skip what is still queued
+            for _, future in pending:
+                future.cancel()
+
+
+def _punctuate(
+    segments: Iterable[Segment],
+    punct: Union[sherpa_onnx.OfflinePunctuation, PunctuationWorker],
+    times: StageTimes,
+) -> Iterator[Segment]:
+    if isinstance(punct, PunctuationWorker):
+        return punct.punctuate(segments, times)
+    return punctuate_segments(segments, punct, times)
+
+
+class SrtWriter:
+    """Append numbered SRT cues to a text file as segments arrive.
+
+    The file is flushed after every cue, so an interrupted run leaves a
+    valid SRT file with everything decoded so far.
+    """
+
+    def __init__(self, f: TextIO):
+        self._f = f
+        self.num_cues = 0
 
-            if punct is not None:
-                seg.text = punct.add_punctuation(seg.text)
-            segment_list.append(seg)
-    all_text = "".join(all_text)
+    def write(self, seg: Segment) -> None:
+        if self.num_cues > 0:
+            self._f.write("\n\n")
+        self.num_cues += 1
+        self._f.write(f"{self.num_cues}\n{seg}")
+        self._f.flush()
+
+
+def write_srt(
+    segments: Iterable[Segment],
+    punct: Optional[Union[sherpa_onnx.OfflinePunctuation, PunctuationWorker]],
+    f: TextIO,
+    times: Optional[StageTimes] = None,
+) -> str:
+    """Write segments to f as SRT cues while they arrive.
+
+    Returns the full text, i.e., the text of all cues. If punct is given,
+    punctuation is added with punctuate_segments(), or on the worker
+    thread if punct is a PunctuationWorker. times, if given,
+    accumulates the time spent on punctuation and on SRT cues.
+
+    A SegmentStore without punct, e.g., a cache hit, is written at once
+    with SegmentStore.to_srt().
+    """
+    if times is None:
+        times = StageTimes()
+
+    if isinstance(segments, SegmentStore) and punct is None:
+        t = time.perf_counter()
+        if not np.all(np.diff(segments._offsets)):
+            segments = SegmentStore.from_segments(_skip_empty(segments))
+        f.write(segments.to_srt())
+        f.flush()
+        times.srt += time.perf_counter() - t
+        return join_texts(segments.texts())
+
+    segments = _skip_empty(segments)
     if punct is not None:
-        all_text = punct.add_punctuation(all_text)
+        segments = _punctuate(segments, punct, times)
+
+    writer = SrtWriter(f)
+
+    all_text = []
+
+    for seg in segments:
+        if len(all_text) > 0:
+            all_text.append(_text_separator(all_text[-1], seg.text))
+        all_text.append(seg.text)
+
+        t = time.perf_counter()
+        writer.write(seg)
+        times.srt += time.perf_counter() - t
+
+    return "".join(all_text)
+
+
+def decode_segments(
+    recognizer: sherpa_onnx.OfflineRecognizer,
+    vad: sherpa_onnx.VoiceActivityDetector,
+    punct: Optional[Union[sherpa_onnx.OfflinePunctuation, PunctuationWorker]],
+    filename: str,
+    batch_size: int = default_batch_size,
+    max_padded_seconds: float = default_max_padded_seconds,
+    num_asr_workers: int = default_num_asr_workers,
+    max_pending_chunks: int = default_max_pending_chunks,
+    speech: Optional[Iterable[List[Tuple[Segment, np.ndarray]]]] = None,
+    speech_recorder=None,
+    pcm: Optional[np.ndarray] = None,
+    times: Optional[StageTimes] = None,
+    checkpoint: Optional[Checkpoint] = None,
+) -> Iterator[Segment]:
+    """Yield recognized segments of filename as soon as they are decoded.
+
+    Segments come in timestamp order. Empty segments are skipped and, if
+    punct is given, punctuation is added as in write_srt(). Memory
+    use does not grow with the length of the input.
+
+    speech and speech_recorder reuse or record the VAD output, see
+    cache.SpeechCache. pcm is the decoded input from cache.PcmCache,
+    which saves running ffmpeg. times, if given, accumulates the time
+    spent in each stage.
+
+    checkpoint, if given, is resumed from and updated as segments come
+    out; see Checkpoint. It cannot be combined with speech.
+    """
+    if times is None:
+        times = StageTimes()
+
+    start = None
+    if checkpoint is not None:
+        if speech is not None:
+            raise ValueError("A checkpoint needs ffmpeg or pcm input, not speech")
+        if checkpoint.offset > 0:
+            start = checkpoint.offset / sample_rate
+            logging.info(f"Resuming {filename} from {start:.3f} s")
+
+    segments = _decode_segments(
+        recognizer,
+        vad,
+        filename,
+        batch_size=batch_size,
+        max_padded_seconds=max_padded_seconds,
+        num_asr_workers=num_asr_workers,
+        max_pending_chunks=max_pending_chunks,
+        start=start,
+        speech=speech,
+        speech_recorder=speech_recorder,
+        pcm=pcm,
+        times=times,
+    )
+    if checkpoint is not None:
+        segments = _checkpointed(segments, checkpoint)
+    segments = _skip_empty(segments)
+    if punct is not None:
+        segments = _punctuate(segments, punct, times)
+    yield from segments
+
+
+def decode(
+    recognizer: sherpa_onnx.OfflineRecognizer,
+    vad: sherpa_onnx.VoiceActivityDetector,
+    punct: Optional[Union[sherpa_onnx.OfflinePunctuation, PunctuationWorker]],
+    filename: str,
+    batch_size: int = default_batch_size,
+    max_padded_seconds: float = default_max_padded_seconds,
+    num_asr_workers: int = default_num_asr_workers,
+    max_pending_chunks: int = default_max_pending_chunks,
+    pcm: Optional[np.ndarray] = None,
+    times: Optional[StageTimes] = None,
+    checkpoint: Optional[Checkpoint] = None,
+    subtitle_format: str = "srt",
+) -> Tuple[str, str]:
+    """Subtitles of filename, in subtitle_format, and the full text."""
+    logging.info("Started!")
+
+    if times is None:
+        times = StageTimes()
+
+    segments = decode_segments(
+        recognizer,
+        vad,
+        punct,
+        filename,
+        batch_size=batch_size,
+        max_padded_seconds=max_padded_seconds,
+        num_asr_workers=num_asr_workers,
+        max_pending_chunks=max_pending_chunks,
+        pcm=pcm,
+        times=times,
+        checkpoint=checkpoint,
+    )
+    return _format_subtitles(
+        SegmentStore.from_segments(segments), subtitle_format, times
+    )
+
+
+def _format_subtitles(
+    store: SegmentStore, subtitle_format: str, times: StageTimes
+) -> Tuple[str, str]:
+    # All cues at once: (SRT or WebVTT text, full text)
+    if subtitle_format not in subtitle_formats:
+        raise ValueError(f"Unsupported subtitle format: {subtitle_format}")
+
+    t = time.perf_counter()
+    if subtitle_format == "vtt":
+        subtitles = store.to_vtt()
+    else:
+        subtitles = store.to_srt()
+    times.srt += time.perf_counter() - t
+    return subtitles, join_texts(store.texts())
+
+
+def _quietest_point(filename: str, start: float, duration: float) -> Optional[float]:
+    """Middle of the quietest stretch of filename in [start, start + duration).
+
+    The stretch is default_split_span_windows VAD windows long, and the
+    result is on a VAD window boundary counted from the start of the input.
+    Returns None if the range is too short.
+    """
+    w = vad_window_size
+    first = round(start * sample_rate) // w * w
+    process = start_ffmpeg(filename, start=first / sample_rate, duration=duration)
+    data = process.stdout.read()
+    if process.wait() != 0:
+        raise RuntimeError(f"ffmpeg failed to decode {filename}")
+
+    samples = np.frombuffer(data, dtype=np.int16)
+    n = len(samples) // w
+    span = default_split_span_windows
+    if n < span:
+        return None
+
+    energy = np.square(samples[: n * w].astype(np.float32)).reshape(n, w).mean(axis=1)
+    sums = np.convolve(energy, np.ones(span, dtype=np.float32), mode="valid")
+    i = int(np.argmin(sums)) + span // 2
+    return (first + i * w) / sample_rate
+
+
+def find_split_points(
+    filename: str,
+    num_ranges: int,
+    duration: Optional[float] = None,
+    search_seconds: float = default_split_search_seconds,
+) -> List[Tuple[float, Optional[float]]]:
+    """Split filename into at most num_ranges (start, duration) time ranges.
+
+    Instead of a VAD pass over the whole input, ffmpeg decodes only
+    search_seconds around each even division of the input, in parallel,
+    and the split goes into the quietest stretch found there. The cost
+    does not grow with the length of the input; a split can cut a word
+    only if someone talks through the whole search range.
+
+    duration is the length of the input, by default from ffprobe; if it
+    is unknown, the input is not split. The duration of the last range is
+    None, i.e., up to the end of the input.
+    """
+    if duration is None:
+        duration = probe_duration(filename)
+    if not duration or num_ranges <= 1:
+        return [(0.0, None)]
+
+    targets = [duration * k / num_ranges for k in range(1, num_ranges)]
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        points = list(
+            executor.map(
+                lambda t: _quietest_point(
+                    filename, max(0.0, t - search_seconds / 2), search_seconds
+                ),
+                targets,
+            )
+        )
+
+    splits = []
+    for point in points:
+        if point is not None and 0 < point < duration:
+            if not splits or point > splits[-1]:
+                splits.append(point)
+
+    starts = [0.0] + splits
+    ends = splits + [None]
+    return [(s, None if e is None else e - s) for s, e in zip(starts, ends)]
+
+
+def _decode_range(
+    repo_id: str,
+    filename: str,
+    start: float,
+    duration: Optional[float],
+    batch_size: int,
+    max_padded_seconds: float,
+) -> Tuple[List[Tuple[float, float, str]], StageTimes]:
+    """Worker process: decode one time range of filename.
+
+    Returns (start, duration, text) tuples with absolute timestamps, and
+    the time spent in each stage.
+    """
+    # Imported here since the recognizer is loaded in the worker process
+    from model import get_pretrained_model, vad_pool
+
+    recognizer = get_pretrained_model(repo_id)
+
+    logging.info(f"Decoding {filename} from {start:.2f} s")
+    times = StageTimes()
+    with vad_pool.acquire() as vad:
+        segments = [
+            (start + seg.start, seg.duration, seg.text)
+            for seg in _decode_segments(
+                recognizer,
+                vad,
+                filename,
+                batch_size=batch_size,
+                max_padded_seconds=max_padded_seconds,
+                num_asr_workers=1,
+                max_pending_chunks=default_max_pending_chunks,
+                start=start,
+                duration=duration,
+                times=times,
+            )
+        ]
+    return segments, times
+
+
+def decode_parallel(
+    repo_id: str,
+    punct: Optional[Union[sherpa_onnx.OfflinePunctuation, PunctuationWorker]],
+    filename: str,
+    num_workers: int,
+    ranges_per_worker: int = 2,
+    batch_size: int = default_batch_size,
+    max_padded_seconds: float = default_max_padded_seconds,
+    executor: Optional[ProcessPoolExecutor] = None,
+    times: Optional[StageTimes] = None,
+    subtitle_format: str = "srt",
+) -> Tuple[str, str]:
+    """Like decode(), but transcribe time ranges of filename in worker processes.
+
+    The input is split at quiet points (see find_split_points()) into
+    num_workers * ranges_per_worker ranges. Each worker process loads
+    its own recognizer for repo_id with model.get_pretrained_model().
+
+    executor, if given, runs the ranges instead of a new pool of
+    num_workers processes, so that the recognizers stay loaded across
+    inputs; see new_process_pool(). times, if given, accumulates the
+    stage times of all ranges.
+    """
+    logging.info("Started!")
+    if times is None:
+        times = StageTimes()
+
+    ranges = find_split_points(filename, num_workers * ranges_per_worker)
+    logging.info(f"Decoding {len(ranges)} ranges with {num_workers} processes")
+
+    with ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(new_process_pool(num_workers))
+        futures = [
+            executor.submit(
+                _decode_range,
+                repo_id,
+                filename,
+                start,
+                duration,
+                batch_size,
+                max_padded_seconds,
+            )
+            for start, duration in ranges
+        ]
+
+        results = [f.result() for f in futures]
+
+    # the ranges come from _decode_segments(), which keeps empty segments
+    segments = SegmentStore.from_segments(
+        _skip_empty(
+            Segment(start=start, duration=duration, text=text)
+            for range_segments, _ in results
+            for start, duration, text in range_segments
+        )
+    )
+    for _, range_times in results:
+        times.read += range_times.read
+        times.vad += range_times.vad
+        times.asr += range_times.asr
+        times.num_samples += range_times.num_samples
+        times.num_segments += range_times.num_segments
+        times.max_pending_chunks = max(
+            times.max_pending_chunks, range_times.max_pending_chunks
+        )
+
+    if punct is not None:
+        segments = SegmentStore.from_segments(_punctuate(segments, punct, times))
+    return _format_subtitles(segments, subtitle_format, times)
+
 
-    return "\n\n".join(f"{i}\n{seg}" for i, seg in enumerate(segment_list, 1)), all_text
+def new_process_pool(num_workers: int) -> ProcessPoolExecutor:
+    """Worker processes for decode_parallel(), started with spawn."""
+    ctx = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(max_workers=num_workers, mp_context=ctx)
@@ -0,0 +1,212 @@
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background transcription jobs.
+
+submit() returns a Job right away; a fixed number of worker threads run
+the jobs in submission order. Clients poll Job.to_dict() or iterate over
+JobQueue.watch() for progress, and read Job.result once it is done.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from decode import Segment, StageTimes, sample_rate
+
+# Jobs waiting for a worker; submit() fails beyond that
+default_max_queued_jobs = int(os.environ.get("SUBTITLES_MAX_QUEUED_JOBS", 16))
+
+# Finished jobs kept for clients to fetch their results
+default_max_finished_jobs = 1000
+
+
+class JobQueueFull(Exception):
+    """Raised by JobQueue.submit() when max_queued jobs are waiting."""
+
+
+@dataclass
+class Job:
+    id: str
+    filename: str
+
+    # "queued", "running", "done" or "failed"
+    status: str = "queued"
+
+    # Length of the input in seconds, if known
+    duration: Optional[float] = None
+
+    # Live timings of the decode; times.num_samples is the audio consumed
+    times: StageTimes = field(default_factory=StageTimes)
+
+    # Segments decoded so far, and the end of the last one in seconds
+    num_segments: int = 0
+    position: float = 0.0
+
+    # Return value of the job function, or the error it raised
+    result: Any = None
+    error: Optional[str] = None
+
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    _done: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    def add_segment(self, seg: Segment) -> None:
+        self.num_segments += 1
+        self.position = seg.end
+
+    def progress(self) -> float:
+        """Fraction of the input processed so far, in [0, 1]."""
+        if self.status == "done":
+            return 1.0
+        if not self.duration:
+            return 0.0
+        consumed = max(self.times.num_samples / sample_rate, self.position)
+        return min(1.0, consumed / self.duration)
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the job has finished. Returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": self.progress(),
+            "duration": self.duration,
+            "num_segments": self.num_segments,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class JobQueue:
+    """Runs jobs on num_workers threads, with at most max_queued waiting.
+
+    A job function is called as fn(job, *args, **kwargs); it updates the
+    progress fields of job while it runs, and its return value becomes
+    job.result. Only the last max_finished finished jobs are kept;
+    on_forget(job) is called for each one dropped.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        max_queued: int = default_max_queued_jobs,
+        max_finished: int = default_max_finished_jobs,
+        on_forget: Optional[Callable[[Job], None]] = None,
+    ):
+        self.num_workers = num_workers
+        self.max_finished = max_finished
+        self.on_forget = on_forget
+
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _start(self) -> None:
+        # Workers are started on the first submit(), so that importing a
+        # module with a JobQueue does not start threads
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.num_workers):
+                t = threading.Thread(target=self._work, name=f"job-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, fn: Callable[..., Any], filename: str, *args, **kwargs) -> Job:
+        """Queue fn for filename. Raises JobQueueFull if no slot is free."""
+        self._start()
+
+        job = Job(id=uuid.uuid4().hex, filename=filename)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait((job, fn, args, kwargs))
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise JobQueueFull(
+                f"{self._queue.maxsize} jobs are waiting; try again later"
+            )
+
+        logging.info(f"Queued job {job.id} for {filename}")
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def watch(self, job: Job, interval: float = 1.0) -> Iterator[Dict[str, Any]]:
+        """Yield job.to_dict() every interval seconds until the job is done."""
+        while not job.wait(interval):
+            yield job.to_dict()
+        yield job.to_dict()
+
+    @property
+    def num_queued(self) -> int:
+        return self._queue.qsize()
+
+    @property
+    def num_running(self) -> int:
+        with self._lock:
+            return sum(job.status == "running" for job in self._jobs.values())
+
+    def _work(self) -> None:
+        while True:
+            job, fn, args, kwargs = self._queue.get()
+            job.status = "running"
+            job.started = time.time()
+            try:
+                job.result = fn(job, *args, **kwargs)
+                job.status = "done"
+            except Exception as e:
+                logging.exception(f"Job {job.id} failed")
+                job.error = str(e) or type(e).__name__
+                job.status = "failed"
+            job.finished = time.time()
+            job._done.set()
+            logging.info(
+                f"Job {job.id} {job.status} in {job.finished - job.started:.3f} s"
+            )
+            self._forget_finished()
+
+    def _forget_finished(self) -> None:
+        with self._lock:
+            finished = [k for k, job in self._jobs.items() if job.done]
+            forgotten = [
+                self._jobs.pop(k)
+                for k in finished[: max(0, len(finished) - self.max_finished)]
+            ]
+
+        if self.on_forget is not None:
+            for job in forgotten:
+                self.on_forget(job)
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+#
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Captions for a live stream, while it is being recorded.
+
+Usage:
+
+    # Anything ffmpeg can read: a network stream, a named pipe, a device
+    python3 live.py --repo-id whisper-tiny.en rtmp://example.com/live/key
+    mkfifo /tmp/audio && python3 live.py --repo-id whisper-tiny.en /tmp/audio
+
+    # A local file fed at real-time pace, e.g., to measure the latency
+    python3 live.py --repo-id whisper-tiny.en --realtime \\
+        --output test.srt --summary latency.json ./test.wav
+
+Partial cues show the speech decoded so far while someone is talking;
+the final cue replaces them once the VAD closes the segment. Latency
+percentiles of both are printed at the end.
+"""
+
+# sherpa_onnx is only needed for type annotations; the recognizer, VAD and
+# punctuation objects are created by model.py
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from decode import (
+    PunctuationWorker,
+    Segment,
+    SrtWriter,
+    StageTimes,
+    WindowFeeder,
+    sample_rate,
+    start_ffmpeg,
+)
+from model import (
+    get_punct_worker,
+    get_recognizer_pool,
+    model_catalog,
+    supports_punctuation,
+    vad_pool,
+)
+
+if TYPE_CHECKING:
+    import sherpa_onnx
+
+# Seconds of audio read from the source at a time. Smaller reads lower
+# the latency, at the cost of more VAD calls.
+default_live_read_seconds = 0.1
+
+# While someone is talking, the speech so far is decoded again after
+# every this many seconds of audio
+default_partial_interval = 1.0
+
+# Partial cues are skipped while the transcriber is more than this many
+# seconds behind the input, so it catches up when decoding is slow
+default_max_lag = 2.0
+
+# The VAD detects speech this long after it started; partial cues decode
+# the audio from that far back
+default_speech_lead = 0.5
+
+# Partial cues decode at most the last this many seconds of a segment
+default_max_partial_seconds = 30.0
+
+
+@dataclass
+class LiveCue:
+    segment: Segment
+
+    # False for a partial cue, which is replaced by the next cue
+    final: bool
+
+    # Seconds from the end of the audio in segment arriving to the cue
+    latency: float
+
+
+def to_pcm(rate: int, samples: np.ndarray) -> np.ndarray:
+    """Convert audio, e.g., from a microphone, to int16 mono at sample_rate."""
+    samples = np.asarray(samples)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if samples.dtype.kind == "f":
+        samples = samples * 32768
+    if rate != sample_rate:
+        n = int(len(samples) * sample_rate / rate)
+        samples = np.interp(
+            np.arange(n) * (rate / sample_rate), np.arange(len(samples)), samples
+        )
+    return np.clip(samples, -32768, 32767).astype(np.int16)
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {"count": 0}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": len(values),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(max(values)),
+    }
+
+
+class LiveTranscriber:
+    """Turn audio arriving in real time into partial and final cues.
+
+    accept() takes the samples received since the last call and returns
+    the cues they complete. Each speech segment found by the VAD is
+    decoded into a final cue as soon as the VAD closes it. While the VAD
+    is in a segment, the audio since its start is decoded again every
+    partial_interval seconds into a partial cue. Partial cues are skipped
+    while the transcriber lags more than max_lag seconds behind the input,
+    so the latency stays bounded when decoding is slower than real time.
+
+    Latency is measured on the clock of the stream: the sample at t
+    seconds is taken to arrive t seconds after the first one, which holds
+    for live sources and for --realtime.
+    """
+
+    def __init__(
+        self,
+        vad: sherpa_onnx.VoiceActivityDetector,
+        punct: Optional[PunctuationWorker] = None,
+        partial_interval: float = default_partial_interval,
+        max_lag: float = default_max_lag,
+        read_seconds: float = default_live_read_seconds,
+    ):
+        self.vad = vad
+        self.punct = punct
+        self.partial_interval = partial_interval
+        self.max_lag = max_lag
+
+        self.times = StageTimes()
+        self.latencies: Dict[str, List[float]] = {"partial": [], "final": []}
+
+        self._frames_per_read = int(read_seconds * sample_rate)
+        self._feeder = WindowFeeder(self._frames_per_read)
+
+        # time.monotonic() at which the first sample arrived
+        self._start_time: Optional[float] = None
+
+        # recent audio for partial cues; _audio[0] is sample _audio_start
+        self._audio = np.zeros(0, dtype=np.float32)
+        self._audio_start = 0
+
+        # sample at which the open segment started, or None in silence
+        self._onset: Optional[int] = None
+        # end of the last final cue, and sample of the last partial cue
+        self._last_end = 0
+        self._last_partial = 0
+
+    @property
+    def num_samples(self) -> int:
+        return self.times.num_samples
+
+    def lag(self) -> float:
+        """Seconds between the newest sample arriving and now."""
+        if self._start_time is None:
+            return 0.0
+        return time.monotonic() - self._arrival(self.num_samples)
+
+    def _arrival(self, sample: int) -> float:
+        return self._start_time + sample / sample_rate
+
+    def accept(
+        self, recognizer: sherpa_onnx.OfflineRecognizer, samples: np.ndarray
+    ) -> List[LiveCue]:
+        """Process int16 samples at sample_rate; returns the new cues."""
+        if self._start_time is None:
+            self._start_time = time.monotonic() - len(samples) / sample_rate
+
+        cues = []
+        for i in range(0, len(samples), self._frames_per_read):
+            chunk = samples[i : i + self._frames_per_read]
+            cues.extend(self._accept(recognizer, chunk))
+        return cues
+
+    def finish(self, recognizer: sherpa_onnx.OfflineRecognizer) -> List[LiveCue]:
+        """Close the open segment at the end of the input, and reset."""
+        t = time.perf_counter()
+        self._feeder.append(np.zeros(self._frames_per_read, dtype=np.int16))
+        self._feeder.feed(self.vad.accept_waveform)
+        self.vad.flush()
+        segments = self._pop_segments()
+        self.times.vad += time.perf_counter() - t
+
+        cues = [c for c in (self._final(recognizer, *s) for s in segments) if c]
+        self.vad.reset()
+        return cues
+
+    def _accept(
+        self, recognizer: sherpa_onnx.OfflineRecognizer, chunk: np.ndarray
+    ) -> List[LiveCue]:
+        t = time.perf_counter()
+        self._feeder.append(chunk)
+        self._feeder.feed(self.vad.accept_waveform)
+        self.times.num_samples += len(chunk)
+        segments = self._pop_segments()
+        in_speech = self.vad.is_speech_detected()
+        self.times.vad += time.perf_counter() - t
+
+        self._keep(chunk)
+
+        cues = [c for c in (self._final(recognizer, *s) for s in segments) if c]
+
+        lead = int(default_speech_lead * sample_rate)
+        if not in_speech:
+            self._onset = None
+        elif self._onset is None:
+            self._onset = max(self._last_end, self.num_samples - lead)
+            self._last_partial = self._onset
+
+        interval = int(self.partial_interval * sample_rate)
+        if (
+            self._onset is not None
+            and self.num_samples - self._last_partial >= interval
+            and self.lag() <= self.max_lag
+        ):
+            cue = self._partial(recognizer)
+            if cue is not None:
+                cues.append(cue)
+
+        return cues
+
+    def _keep(self, chunk: np.ndarray) -> None:
+        # Only the open segment, or the lead before the next one, is kept
+        self._audio = np.concatenate([self._audio, chunk / np.float32(32768)])
+        keep_from = self.num_samples - int(default_speech_lead * sample_rate)
+        if self._onset is not None:
+            keep_from = min(keep_from, self._onset)
+        keep_from = max(
+            keep_from,
+            self.num_samples - int(default_max_partial_seconds * sample_rate),
+        )
+        if keep_from > self._audio_start:
+            self._audio = self._audio[keep_from - self._audio_start :]
+            self._audio_start = keep_from
+
+    def _pop_segments(self) -> List[Tuple[int, list]]:
+        segments = []
+        while not self.vad.empty():
+            front = self.vad.front
+            segments.append((front.start, front.samples))
+            self.vad.pop()
+        return segments
+
+    def _decode(self, recognizer: sherpa_onnx.OfflineRecognizer, samples) -> str:
+        t = time.perf_counter()
+        stream = recognizer.create_stream()
+        stream.accept_waveform(sample_rate, samples)
+        recognizer.decode_stream(stream)
+        self.times.asr += time.perf_counter() - t
+        return stream.result.text.strip()
+
+    def _final(
+        self, recognizer: sherpa_onnx.OfflineRecognizer, start: int, samples
+    ) -> Optional[LiveCue]:
+        end = start + len(samples)
+        self._last_end = end
+        self._onset = None
+        self.times.num_segments += 1
+
+        seg = Segment(
+            start=start / sample_rate,
+            duration=len(samples) / sample_rate,
+            text=self._decode(recognizer, samples),
+        )
+        if not seg.text:
+            return None
+        if self.punct is not None:
+            (seg,) = self.punct.punctuate([seg], self.times)
+
+        latency = time.monotonic() - self._arrival(end)
+        self.latencies["final"].append(latency)
+        return LiveCue(segment=seg, final=True, latency=latency)
+
+    def _partial(self, recognizer: sherpa_onnx.OfflineRecognizer) -> Optional[LiveCue]:
+        self._last_partial = self.num_samples
+        start = max(self._onset, self._audio_start)
+        text = self._decode(recognizer, self._audio[start - self._audio_start :])
+        if not text:
+            return None
+
+        seg = Segment(
+            start=start / sample_rate,
+            duration=(self.num_samples - start) / sample_rate,
+            text=text,
+        )
+        latency = time.monotonic() - self._arrival(self.num_samples)
+        self.latencies["partial"].append(latency)
+        return LiveCue(segment=seg, final=False, latency=latency)
+
+    def latency_percentiles(self) -> Dict[str, Dict[str, float]]:
+        """Count, p50, p90, p99 and max latency in seconds by cue kind."""
+        return {kind: _percentiles(v) for kind, v in self.latencies.items()}
+
+    def transcribe(
+        self,
+        recognizer: sherpa_onnx.OfflineRecognizer,
+        source: str,
+        realtime: bool = False,
+    ) -> Iterator[LiveCue]:
+        """Yield the cues of source, read with ffmpeg, as they are decoded."""
+        process = start_ffmpeg(source, realtime=realtime)
+        raw = bytearray(self._frames_per_read * 2)
+        try:
+            while True:
+                t = time.perf_counter()
+                # *2 because int16_t has two bytes
+                n = (process.stdout.readinto(raw) or 0) // 2
+                self.times.read += time.perf_counter() - t
+                if n == 0:
+                    break
+                samples = np.frombuffer(raw, dtype=np.int16, count=n)
+                yield from self.accept(recognizer, samples)
+            yield from self.finish(recognizer)
+        finally:
+            process.kill()
+            process.wait()
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--repo-id", type=str, required=True)
+    parser.add_argument(
+        "--punctuation",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Add punctuation to final cues, for models that need it",
+    )
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="Read the source at its native pace, e.g., to test with a file",
+    )
+    parser.add_argument(
+        "--partial-interval",
+        type=float,
+        default=default_partial_interval,
+        help="Seconds of speech between partial cues",
+    )
+    parser.add_argument(
+        "--max-lag",
+        type=float,
+        default=default_max_lag,
+        help="Skip partial cues while this many seconds behind the input",
+    )
+    parser.add_argument("--output", type=str, help="Also write final cues as SRT")
+    parser.add_argument(
+        "--summary",
+        type=str,
+        help="Write the latency percentiles as JSON to this file",
+    )
+    parser.add_argument(
+        "source", type=str, help="URL, named pipe or file readable by ffmpeg"
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.repo_id not in model_catalog:
+        raise SystemExit(f"Unsupported repo_id: {args.repo_id}")
+
+    punct = None
+    if args.punctuation and supports_punctuation(args.repo_id):
+        punct = get_punct_worker()
+
+    f = open(args.output, "w", encoding="utf-8") if args.output else None
+    writer = SrtWriter(f) if f else None
+    try:
+        with get_recognizer_pool(args.repo_id, 1).acquire() as recognizer:
+            with vad_pool.acquire() as vad:
+                transcriber = LiveTranscriber(
+                    vad,
+                    punct,
+                    partial_interval=args.partial_interval,
+                    max_lag=args.max_lag,
+                )
+                for cue in transcriber.transcribe(
+                    recognizer, args.source, realtime=args.realtime
+                ):
+                    kind = "final" if cue.final else "partial"
+                    timing, text = str(cue.segment).split("\n", 1)
+                    print(
+                        f"{kind:>7} {cue.latency * 1000:6.0f} ms  {timing}  {text}",
+                        flush=True,
+                    )
+                    if cue.final and writer is not None:
+                        writer.write(cue.segment)
+    finally:
+        if f is not None:
+            f.close()
+
+    percentiles = transcriber.latency_percentiles()
+    for kind, p in percentiles.items():
+        if p["count"]:
+            print(
+                f"{kind} latency over {p['count']} cues: "
+                f"p50 {p['p50'] * 1000:.0f} ms, p90 {p['p90'] * 1000:.0f} ms, "
+                f"p99 {p['p99'] * 1000:.0f} ms, max {p['max'] * 1000:.0f} ms"
+            )
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "repo_id": args.repo_id,
+                    "source": args.source,
+                    "realtime": args.realtime,
+                    "partial_interval": args.partial_interval,
+                    "audio_seconds": transcriber.num_samples / sample_rate,
+                    "latency": percentiles,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()
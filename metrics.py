@@ -0,0 +1,300 @@
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-stage metrics of the requests served by the app.
+
+Metrics are enabled by setting SUBTITLES_METRICS_PORT, which serves them
+at http://<host>:<port>/metrics in the Prometheus text format, where host
+is SUBTITLES_METRICS_HOST, GRADIO_SERVER_NAME or 127.0.0.1, and/or
+SUBTITLES_METRICS_FILE, which is rewritten in the same format after every
+request. When neither is set, nothing is recorded.
+
+Requests can be profiled with cProfile: SUBTITLES_PROFILE=<n> profiles
+the first n requests, and POST /profile?requests=<n> on the metrics port
+profiles the next n. Profiles are written to SUBTITLES_PROFILE_DIR.
+"""
+
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from decode import StageTimes, sample_rate
+
+# (type, help) of every metric
+_metrics = {
+    "subtitles_requests_total": ("counter", "Finished requests by status"),
+    "subtitles_requests_in_progress": ("gauge", "Requests being decoded"),
+    "subtitles_request_seconds": ("summary", "Wall time of requests"),
+    "subtitles_stage_seconds_total": (
+        "counter",
+        "Seconds spent in each stage of the decoding pipeline",
+    ),
+    "subtitles_audio_seconds_total": (
+        "counter",
+        "Seconds of input audio decoded by ffmpeg",
+    ),
+    "subtitles_segments_total": ("counter", "Speech segments found by the VAD"),
+    "subtitles_pending_chunks_max": (
+        "gauge",
+        "Most chunks waiting for the ASR stage during the last request",
+    ),
+}
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Metrics:
+    """Thread-safe counters and gauges in the Prometheus text format.
+
+    All recording methods return immediately when enabled is False.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        filename: Optional[str] = None,
+        profile_dir: str = "./cache/profiles",
+        num_profiled: int = 0,
+    ):
+        self.enabled = enabled
+        self.filename = filename
+        self.profile_dir = Path(profile_dir)
+
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, tuple], float] = {}
+        self._callbacks: Dict[str, Tuple[str, str, Callable[[], float]]] = {}
+
+        # requests still to be profiled, and profiles saved so far
+        self._num_profiled = num_profiled
+        self._num_profiles = 0
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def register(
+        self, name: str, kind: str, description: str, fn: Callable[[], float]
+    ) -> None:
+        """Report fn() as metric name, evaluated at each render()."""
+        self._callbacks[name] = (kind, description, fn)
+
+    def observe(self, times: StageTimes, seconds: float) -> None:
+        """Record one finished decode that took seconds of wall time."""
+        if not self.enabled:
+            return
+        self.inc("subtitles_request_seconds_sum", seconds)
+        self.inc("subtitles_request_seconds_count")
+        for stage, value in (
+            ("ffmpeg", times.read),
+            ("vad", times.vad),
+            ("asr", times.asr),
+            ("punctuation", times.punct),
+            ("srt", times.srt),
+        ):
+            self.inc("subtitles_stage_seconds_total", value, stage=stage)
+        self.inc("subtitles_audio_seconds_total", times.num_samples / sample_rate)
+        self.inc("subtitles_segments_total", times.num_segments)
+        self.set("subtitles_pending_chunks_max", times.max_pending_chunks)
+
+    @contextmanager
+    def request(
+        self, name: str = "request", times: Optional[StageTimes] = None
+    ) -> Iterator[StageTimes]:
+        """Time one request; pass the StageTimes to the decoding functions.
+
+        times, if given, is used instead of a new StageTimes. The request
+        is profiled if profiling has been switched on for it.
+        """
+        if times is None:
+            times = StageTimes()
+        profile = self._start_profile()
+        self.inc("subtitles_requests_in_progress")
+        start = time.perf_counter()
+        status = "error"
+        try:
+            yield times
+            status = "ok"
+        finally:
+            elapsed = time.perf_counter() - start
+            self.inc("subtitles_requests_in_progress", -1)
+            self.inc("subtitles_requests_total", status=status)
+            if status == "ok":
+                self.observe(times, elapsed)
+            if profile is not None:
+                self._save_profile(*profile, name)
+            logging.info(
+                f"{name} took {elapsed:.3f} s: ffmpeg {times.read:.3f} s, "
+                f"VAD {times.vad:.3f} s, ASR {times.asr:.3f} s, "
+                f"punctuation {times.punct:.3f} s, SRT {times.srt:.3f} s, "
+                f"{times.num_segments} segments"
+            )
+            if self.enabled and self.filename:
+                self.dump()
+
+    def profile_next(self, n: int = 1) -> None:
+        """Profile the next n requests."""
+        with self._lock:
+            self._num_profiled += n
+
+    def _start_profile(self) -> Optional[Tuple[cProfile.Profile, int]]:
+        """Returns the profiler and the number of the profile, if any."""
+        if self._num_profiled <= 0:
+            return None
+        with self._lock:
+            if self._num_profiled <= 0:
+                return None
+            self._num_profiled -= 1
+            self._num_profiles += 1
+            number = self._num_profiles
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler, number
+
+    def _save_profile(
+        self, profiler: cProfile.Profile, number: int, name: str
+    ) -> None:
+        # Only the thread handling the request is profiled; time spent in
+        # the ffmpeg, VAD and ASR threads shows up as waiting here and is
+        # broken down by the stage metrics instead.
+        profiler.disable()
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        filename = self.profile_dir / f"{stamp}-{number}-{name}.prof"
+        profiler.dump_stats(filename)
+
+        s = io.StringIO()
+        pstats.Stats(profiler, stream=s).sort_stats("cumulative").print_stats(20)
+        logging.info(f"Saved profile to {filename}\n{s.getvalue()}")
+
+    def render(self) -> str:
+        with self._lock:
+            values = dict(self._values)
+
+        lines = []
+        for name, (kind, description) in _metrics.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (key, labels), value in sorted(values.items()):
+                if key == name or key.startswith(f"{name}_"):
+                    lines.append(f"{key}{_format_labels(labels)} {value:g}")
+
+        for name, (kind, description, fn) in sorted(self._callbacks.items()):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {fn():g}")
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self) -> None:
+        """Write render() to filename."""
+        path = Path(self.filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve GET /metrics and POST /profile from a daemon thread."""
+        server = ThreadingHTTPServer((host, port), _handler(self))
+        threading.Thread(
+            target=server.serve_forever, name="metrics", daemon=True
+        ).start()
+        logging.info(f"Serving metrics at http://{host}:{port}/metrics")
+        return server
+
+
+def _handler(m: Metrics):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if urlparse(self.path).path != "/metrics":
+                self.send_error(404)
+                return
+            self._reply(m.render(), "text/plain; version=0.0.4")
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path != "/profile":
+                self.send_error(404)
+                return
+            try:
+                n = int(parse_qs(url.query).get("requests", ["1"])[0])
+            except ValueError:
+                self.send_error(400, "requests must be an integer")
+                return
+            m.profile_next(n)
+            self._reply(f"Profiling the next {n} requests\n", "text/plain")
+
+        def _reply(self, body: str, content_type: str):
+            data = body.encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # scrapes would flood the log
+            pass
+
+    return Handler
+
+
+_port = os.environ.get("SUBTITLES_METRICS_PORT")
+_filename = os.environ.get("SUBTITLES_METRICS_FILE")
+
+# POST /profile is not authenticated, so only the app's own interface,
+# by default the loopback one, is listened on
+_host = os.environ.get(
+    "SUBTITLES_METRICS_HOST", os.environ.get("GRADIO_SERVER_NAME", "127.0.0.1")
+)
+
+metrics = Metrics(
+    enabled=bool(_port or _filename),
+    filename=_filename,
+    profile_dir=os.environ.get("SUBTITLES_PROFILE_DIR", "./cache/profiles"),
+    num_profiled=int(os.environ.get("SUBTITLES_PROFILE", "0")),
+)
+
+
+def start_server() -> None:
+    """Start serving metrics if SUBTITLES_METRICS_PORT is set."""
+    if _port:
+        metrics.serve(int(_port), _host)
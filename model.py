@@ -14,12 +14,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from functools import lru_cache
+# sherpa_onnx and huggingface_hub are imported by the functions that use
+# them, so importing this module, e.g., for model_catalog, stays cheap
+from __future__ import annotations
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 import logging
-import sherpa_onnx
-from huggingface_hub import hf_hub_download
-
-sample_rate = 16000
+import os
+import queue
+import threading
+import time
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+import numpy as np
+
+from decode import PunctuationWorker, sample_rate
+from registry import registry
+
+if TYPE_CHECKING:
+    import sherpa_onnx
+
+_num_cpus = os.cpu_count() or 2
+
+# Intra-op threads of each recognizer instance
+default_num_threads = int(
+    os.environ.get("SUBTITLES_NUM_THREADS", min(2, _num_cpus))
+)
+
+
+def _physical_memory() -> int:
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        # e.g., on Windows
+        return 16 << 30
+
+
+# Budget for loaded recognizers, in bytes; see ModelCache
+default_model_cache_bytes = int(
+    os.environ.get("SUBTITLES_MODEL_CACHE_BYTES", _physical_memory() // 2)
+)
+
+
+def _parse_quantization(value: str) -> Dict[str, str]:
+    # "fp32" or "int8" applies to all models; "repo_id=fp32" to one.
+    # Entries are separated by commas.
+    overrides = {}
+    for entry in filter(None, value.split(",")):
+        repo_id, _, q = entry.rpartition("=")
+        if q not in ("int8", "fp32"):
+            raise ValueError(
+                f"Invalid quantization in SUBTITLES_QUANTIZATION: {entry}"
+            )
+        overrides[repo_id] = q
+    return overrides
+
+
+# Quantization variant per repo_id ("" for all models); see get_quantization()
+quantization_overrides = _parse_quantization(
+    os.environ.get("SUBTITLES_QUANTIZATION", "")
+)
+
+# Recognizer instances per model, i.e., requests decoded concurrently
+default_pool_size = int(
+    os.environ.get(
+        "SUBTITLES_POOL_SIZE", max(1, min(4, _num_cpus // default_num_threads))
+    )
+)
 
 
 def _get_nn_model_filename(
@@ -27,30 +101,38 @@ def _get_nn_model_filename(
     filename: str,
     subfolder: str = "exp",
 ) -> str:
-    nn_model_filename = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        subfolder=subfolder,
-        local_dir=f"./models/{repo_id}/{filename}/{subfolder}",
-    )
-    logging.info(f"Downloaded: {repo_id}/{filename}/{subfolder}")
-    return nn_model_filename
+    def download():
+        from huggingface_hub import hf_hub_download
+
+        nn_model_filename = hf_hub_download(
+            repo_id=repo_id,
+            filename=filename,
+            subfolder=subfolder,
+            local_dir=f"./models/{repo_id}/{filename}/{subfolder}",
+        )
+        logging.info(f"Downloaded: {repo_id}/{filename}/{subfolder}")
+        return nn_model_filename
+
+    return registry.resolve(repo_id, filename, subfolder, download)
 
 
 get_file = _get_nn_model_filename
 
 
+def _download(repo_id: str, filename: str, subfolder: str) -> str:
+    from huggingface_hub import hf_hub_download
+
+    return hf_hub_download(repo_id=repo_id, filename=filename, subfolder=subfolder)
+
+
 def _get_bpe_model_filename(
     repo_id: str,
     filename: str = "bpe.model",
     subfolder: str = "data/lang_bpe_500",
 ) -> str:
-    bpe_model_filename = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        subfolder=subfolder,
+    return registry.resolve(
+        repo_id, filename, subfolder, lambda: _download(repo_id, filename, subfolder)
     )
-    return bpe_model_filename
 
 
 def _get_token_filename(
@@ -58,144 +140,251 @@ def _get_token_filename(
     filename: str = "tokens.txt",
     subfolder: str = "data/lang_char",
 ) -> str:
-    token_filename = hf_hub_download(
-        repo_id=repo_id,
-        filename=filename,
-        subfolder=subfolder,
-    )
-    return token_filename
-
-
-@lru_cache(maxsize=10)
-def _get_whisper_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    name = repo_id.split("-")[1]
-    assert name in ("tiny.en", "base.en", "small.en", "medium.en"), repo_id
-    full_repo_id = "csukuangfj/sherpa-onnx-whisper-" + name
-    encoder = _get_nn_model_filename(
-        repo_id=full_repo_id,
-        filename=f"{name}-encoder.int8.onnx",
-        subfolder=".",
-    )
-
-    decoder = _get_nn_model_filename(
-        repo_id=full_repo_id,
-        filename=f"{name}-decoder.int8.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(
-        repo_id=full_repo_id, subfolder=".", filename=f"{name}-tokens.txt"
-    )
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_whisper(
-        encoder=encoder,
-        decoder=decoder,
-        tokens=tokens,
-        num_threads=2,
-        tail_paddings=2000,
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=10)
-def _get_paraformer_zh_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in [
-        "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28",
-    ], repo_id
-
-    nn_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="model.int8.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_paraformer(
-        paraformer=nn_model,
-        tokens=tokens,
-        num_threads=2,
-        sample_rate=sample_rate,
-        feature_dim=80,
-        decoding_method="greedy_search",
-        debug=False,
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=5)
-def _get_chinese_dialect_models(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in [
-        "csukuangfj/sherpa-onnx-telespeech-ctc-int8-zh-2024-06-04",
-    ], repo_id
-
-    nn_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="model.int8.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_telespeech_ctc(
-        model=nn_model,
-        tokens=tokens,
-        num_threads=2,
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=10)
-def _get_russian_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in (
-        "alphacep/vosk-model-ru",
-        "alphacep/vosk-model-small-ru",
-    ), repo_id
+    return registry.resolve(
+        repo_id, filename, subfolder, lambda: _download(repo_id, filename, subfolder)
+    )
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """How to build the recognizer of one entry in model_catalog.
+
+    files maps each file argument of the sherpa_onnx.OfflineRecognizer
+    factory for model_type (e.g., encoder, decoder, joiner, tokens) to
+    (filename, subfolder) on the hub. "{q}" in a filename is replaced by
+    ".int8" for the int8 variant and removed for fp32; files without it
+    are the same in both variants.
+    """
+
+    model_type: str
+    files: Dict[str, Tuple[str, str]]
+
+    # Repository on the hub, if it differs from the repo_id
+    hub_repo: Optional[str] = None
+
+    # Default quantization variant, "int8" or "fp32"
+    quantization: str = "fp32"
+
+    # Intra-op threads, if different from default_num_threads
+    num_threads: Optional[int] = None
+
+    # Further keyword arguments for the factory
+    options: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def variants(self) -> Tuple[str, ...]:
+        if any("{q}" in filename for filename, _ in self.files.values()):
+            return ("int8", "fp32")
+        return (self.quantization,)
+
+    def resources(
+        self, repo_id: str, quantization: Optional[str] = None
+    ) -> Dict[str, Tuple[str, str, str]]:
+        """(hub repo, filename, subfolder) of each file the model needs."""
+        quantization = quantization or self.quantization
+        if quantization not in self.variants:
+            raise ValueError(
+                f"{repo_id} has no {quantization} variant. "
+                f"Available: {', '.join(self.variants)}"
+            )
+
+        q = ".int8" if quantization == "int8" else ""
+        hub_repo = self.hub_repo or repo_id
+        return {
+            name: (hub_repo, filename.format(q=q), subfolder)
+            for name, (filename, subfolder) in self.files.items()
+        }
+
+
+# Name of the sherpa_onnx.OfflineRecognizer factory of each model_type
+_factories = {
+    "transducer": "from_transducer",
+    "paraformer": "from_paraformer",
+    "whisper": "from_whisper",
+    "telespeech_ctc": "from_telespeech_ctc",
+    "sense_voice": "from_sense_voice",
+}
 
-    if repo_id == "alphacep/vosk-model-ru":
-        model_dir = "am-onnx"
-    elif repo_id == "alphacep/vosk-model-small-ru":
-        model_dir = "am"
+_transducer_options = dict(
+    sample_rate=sample_rate,
+    feature_dim=80,
+    decoding_method="greedy_search",
+)
+
+
+def _transducer(
+    epoch: str, subfolder: str, tokens: Tuple[str, str], **kwargs
+) -> ModelSpec:
+    # The file names used by icefall exports
+    return ModelSpec(
+        model_type="transducer",
+        files={
+            "encoder": (f"encoder-{epoch}.onnx", subfolder),
+            "decoder": (f"decoder-{epoch}.onnx", subfolder),
+            "joiner": (f"joiner-{epoch}.onnx", subfolder),
+            "tokens": tokens,
+        },
+        options=_transducer_options,
+        **kwargs,
+    )
+
+
+def _whisper(name: str) -> ModelSpec:
+    return ModelSpec(
+        model_type="whisper",
+        hub_repo=f"csukuangfj/sherpa-onnx-whisper-{name}",
+        files={
+            "encoder": (f"{name}-encoder{{q}}.onnx", "."),
+            "decoder": (f"{name}-decoder{{q}}.onnx", "."),
+            "tokens": (f"{name}-tokens.txt", "."),
+        },
+        quantization="int8",
+        options=dict(tail_paddings=2000),
+    )
+
+
+def _vosk(model_dir: str) -> ModelSpec:
+    return ModelSpec(
+        model_type="transducer",
+        files={
+            "encoder": ("encoder.onnx", model_dir),
+            "decoder": ("decoder.onnx", model_dir),
+            "joiner": ("joiner.onnx", model_dir),
+            "tokens": ("tokens.txt", "lang"),
+        },
+        options=_transducer_options,
+    )
+
+
+def _with_int8(spec: ModelSpec, *names: str) -> ModelSpec:
+    # The listed files come in int8 and fp32 variants, int8 by default
+    files = dict(spec.files)
+    for name in names:
+        filename, subfolder = files[name]
+        files[name] = (filename.replace(".onnx", "{q}.onnx"), subfolder)
+    return ModelSpec(
+        model_type=spec.model_type,
+        files=files,
+        hub_repo=spec.hub_repo,
+        quantization="int8",
+        num_threads=spec.num_threads,
+        options=spec.options,
+    )
+
+
+# repo_id -> ModelSpec, for every model that can be selected in the UI
+model_catalog: Dict[str, ModelSpec] = {
+    "csukuangfj/sherpa-onnx-telespeech-ctc-int8-zh-2024-06-04": ModelSpec(
+        model_type="telespeech_ctc",
+        files={
+            "model": ("model.int8.onnx", "."),
+            "tokens": ("tokens.txt", "."),
+        },
+        quantization="int8",
+    ),
+    "csukuangfj/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17": ModelSpec(
+        model_type="sense_voice",
+        files={
+            "model": ("model{q}.onnx", "."),
+            "tokens": ("tokens.txt", "."),
+        },
+        quantization="int8",
+        options=dict(
+            sample_rate=sample_rate,
+            feature_dim=80,
+            decoding_method="greedy_search",
+            debug=True,
+            use_itn=True,
+        ),
+    ),
+    "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28": ModelSpec(
+        model_type="paraformer",
+        files={
+            "paraformer": ("model{q}.onnx", "."),
+            "tokens": ("tokens.txt", "."),
+        },
+        quantization="int8",
+        options=dict(
+            sample_rate=sample_rate,
+            feature_dim=80,
+            decoding_method="greedy_search",
+            debug=False,
+        ),
+    ),
+    "csukuangfj/sherpa-onnx-conformer-zh-stateless2-2023-05-23": _transducer(
+        "epoch-99-avg-1", ".", ("tokens.txt", ".")
+    ),
+    "zrjin/sherpa-onnx-zipformer-multi-zh-hans-2023-9-2": _transducer(
+        "epoch-20-avg-1", ".", ("tokens.txt", ".")
+    ),
+    "whisper-tiny.en": _whisper("tiny.en"),
+    "whisper-base.en": _whisper("base.en"),
+    "whisper-small.en": _whisper("small.en"),
+    "whisper-distil-small.en": _whisper("distil-small.en"),
+    "whisper-medium.en": _whisper("medium.en"),
+    "whisper-distil-medium.en": _whisper("distil-medium.en"),
+    "yfyeung/icefall-asr-multidataset-pruned_transducer_stateless7-2023-05-04": _transducer(  # noqa
+        "epoch-30-avg-4", "exp", ("tokens.txt", "lang_bpe_500")
+    ),
+    "alphacep/vosk-model-ru": _vosk("am-onnx"),
+    "alphacep/vosk-model-small-ru": _vosk("am"),
+    "k2-fsa/sherpa-onnx-zipformer-korean-2024-06-24": _with_int8(
+        _transducer("epoch-99-avg-1", ".", ("tokens.txt", ".")), "encoder"
+    ),
+    "yfyeung/icefall-asr-gigaspeech2-th-zipformer-2024-06-20": _with_int8(
+        _transducer("epoch-12-avg-5", "exp", ("tokens.txt", "data/lang_bpe_2000")),
+        "encoder",
+        "joiner",
+    ),
+    "reazon-research/reazonspeech-k2-v2": _with_int8(
+        _transducer("epoch-99-avg-1", ".", ("tokens.txt", ".")), "encoder"
+    ),
+}
 
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder.onnx",
-        subfolder=model_dir,
-    )
 
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder.onnx",
-        subfolder=model_dir,
-    )
+def get_model_files(
+    repo_id: str, quantization: Optional[str] = None
+) -> Dict[str, str]:
+    """Local paths of the files of a model, downloading them if needed."""
+    spec = model_catalog[repo_id]
+    files = {}
+    for name, (hub_repo, filename, subfolder) in spec.resources(
+        repo_id, quantization
+    ).items():
+        if name == "tokens":
+            files[name] = _get_token_filename(
+                repo_id=hub_repo, filename=filename, subfolder=subfolder
+            )
+        else:
+            files[name] = _get_nn_model_filename(
+                repo_id=hub_repo, filename=filename, subfolder=subfolder
+            )
+    return files
+
+
+def _load_recognizer(
+    repo_id: str,
+    num_threads: Optional[int] = None,
+    quantization: Optional[str] = None,
+) -> sherpa_onnx.OfflineRecognizer:
+    spec = model_catalog.get(repo_id)
+    if spec is None:
+        raise ValueError(f"Unsupported repo_id: {repo_id}")
 
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner.onnx",
-        subfolder=model_dir,
-    )
+    import sherpa_onnx
 
-    tokens = _get_token_filename(repo_id=repo_id, subfolder="lang")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-        decoding_method="greedy_search",
+    factory = getattr(sherpa_onnx.OfflineRecognizer, _factories[spec.model_type])
+    return factory(
+        **get_model_files(repo_id, quantization),
+        num_threads=num_threads or spec.num_threads or default_num_threads,
+        **spec.options,
     )
 
-    return recognizer
-
 
 @lru_cache(maxsize=2)
 def get_punct_model() -> sherpa_onnx.OfflinePunctuation:
+    import sherpa_onnx
+
     model = _get_nn_model_filename(
         repo_id="csukuangfj/sherpa-onnx-punct-ct-transformer-zh-en-vocab272727-2024-04-12",
         filename="model.onnx",
@@ -209,7 +398,28 @@ def get_punct_model() -> sherpa_onnx.OfflinePunctuation:
     return punct
 
 
+@lru_cache(maxsize=1)
+def get_punct_worker() -> PunctuationWorker:
+    """The punctuation model behind the thread that punctuates the segments
+    of all requests, see decode.PunctuationWorker."""
+    return PunctuationWorker(get_punct_model())
+
+
+def supports_punctuation(repo_id: str) -> bool:
+    """Whether the punctuation model should be applied to the output of
+    repo_id. Models that already produce punctuation, and languages the
+    punctuation model does not handle, are excluded."""
+    return not (
+        "whisper" in repo_id
+        or "korean" in repo_id
+        or "vosk-model" in repo_id
+        or "asr-gigaspeech2-th-zipformer" in repo_id
+    )
+
+
 def get_vad() -> sherpa_onnx.VoiceActivityDetector:
+    import sherpa_onnx
+
     vad_model = _get_nn_model_filename(
         repo_id="csukuangfj/vad",
         filename="silero_vad_v5.onnx",
@@ -230,346 +440,355 @@ def get_vad() -> sherpa_onnx.VoiceActivityDetector:
     return vad
 
 
-@lru_cache(maxsize=10)
-def get_pretrained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    if repo_id in chinese_models:
-        return chinese_models[repo_id](repo_id)
-    elif repo_id in chinese_dialect_models:
-        return chinese_dialect_models[repo_id](repo_id)
-    elif repo_id in english_models:
-        return english_models[repo_id](repo_id)
-    elif repo_id in chinese_english_mixed_models:
-        return chinese_english_mixed_models[repo_id](repo_id)
-    elif repo_id in russian_models:
-        return russian_models[repo_id](repo_id)
-    elif repo_id in korean_models:
-        return korean_models[repo_id](repo_id)
-    elif repo_id in thai_models:
-        return thai_models[repo_id](repo_id)
-    elif repo_id in japanese_models:
-        return japanese_models[repo_id](repo_id)
-    elif repo_id in zh_en_ko_ja_yue_models:
-        return zh_en_ko_ja_yue_models[repo_id](repo_id)
-    else:
+def _warm_up_samples(seconds: float = 1.0) -> np.ndarray:
+    # Low-level noise; enough to run every operator of the models once
+    rng = np.random.default_rng(0)
+    return rng.uniform(-0.05, 0.05, int(seconds * sample_rate)).astype(np.float32)
+
+
+def warm_up_recognizer(recognizer: sherpa_onnx.OfflineRecognizer) -> None:
+    """Decode synthetic audio so that the first request does not pay for
+    ONNX Runtime's lazy initialization."""
+    stream = recognizer.create_stream()
+    stream.accept_waveform(sample_rate, _warm_up_samples())
+    recognizer.decode_stream(stream)
+
+
+class VadPool:
+    """Reusable VoiceActivityDetector instances.
+
+    The VAD is stateful, so instances cannot be shared by concurrent
+    requests. acquire() lends an idle instance, creating one with
+    get_vad() only if none is idle, and resets it when it is returned,
+    so every user starts from a clean state with timestamps from 0.
+    """
+
+    def __init__(self):
+        self._idle = queue.Queue()
+
+    @contextmanager
+    def acquire(self) -> Iterator[sherpa_onnx.VoiceActivityDetector]:
+        try:
+            vad = self._idle.get_nowait()
+        except queue.Empty:
+            vad = get_vad()
+
+        try:
+            yield vad
+        finally:
+            # drops buffered samples and pending segments, and resets the
+            # model state and the sample counter
+            vad.reset()
+            self._idle.put(vad)
+
+    def fill(self, n: int) -> None:
+        """Create and warm up instances until n are idle."""
+        while self._idle.qsize() < n:
+            vad = get_vad()
+            vad.accept_waveform(_warm_up_samples())
+            vad.flush()
+            vad.reset()
+            self._idle.put(vad)
+
+
+vad_pool = VadPool()
+
+
+class RecognizerPool:
+    """Up to size recognizer instances of one model.
+
+    Each request checks an instance out with acquire(), so concurrent
+    requests decode in parallel instead of sharing one recognizer.
+    Instances are created on first demand and kept afterwards. grow()
+    raises size in place.
+
+    on_load() is called after each new instance, with nbytes updated.
+    """
+
+    def __init__(
+        self,
+        repo_id: str,
+        size: int,
+        num_threads: Optional[int],
+        quantization: Optional[str] = None,
+        on_load: Optional[Callable[[], None]] = None,
+    ):
+        self.repo_id = repo_id
+        self.size = size
+        self.num_threads = num_threads
+        self.quantization = quantization
+        self.on_load = on_load
+
+        # Approximate resident size of all instances: the size of the
+        # model files each instance was loaded from
+        self.nbytes = 0
+
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._num_created = 0
+
+    def _create(self) -> Optional[sherpa_onnx.OfflineRecognizer]:
+        """Load a new instance, or return None if the pool is full."""
+        with self._lock:
+            if self._num_created >= self.size:
+                return None
+            self._num_created += 1
+
+        try:
+            with registry.record() as files:
+                recognizer = _load_recognizer(
+                    self.repo_id, self.num_threads, self.quantization
+                )
+        except BaseException:
+            with self._lock:
+                self._num_created -= 1
+            raise
+
+        nbytes = sum(os.path.getsize(path) for _, path in files)
+        with self._lock:
+            self.nbytes += nbytes
+
+        logging.info(
+            f"Created recognizer {self._num_created}/{self.size} for {self.repo_id} "
+            f"({self.quantization}, {nbytes / 1e6:.1f} MB)"
+        )
+        if self.on_load is not None:
+            self.on_load()
+        return recognizer
+
+    def grow(self, size: int) -> None:
+        """Allow up to size instances, if that is more than now."""
+        with self._lock:
+            self.size = max(self.size, size)
+
+    def fill(self, n: Optional[int] = None) -> None:
+        """Create and warm up instances until n, by default size, exist."""
+        while n is None or self._num_created < n:
+            recognizer = self._create()
+            if recognizer is None:
+                break
+            warm_up_recognizer(recognizer)
+            self._idle.put(recognizer)
+
+    def shared(self) -> sherpa_onnx.OfflineRecognizer:
+        """The first instance of the pool, without checking it out.
+
+        For callers that decode from one thread at a time, see
+        get_pretrained_model().
+        """
+        with self.acquire() as recognizer:
+            pass
+        return recognizer
+
+    @contextmanager
+    def acquire(self) -> Iterator[sherpa_onnx.OfflineRecognizer]:
+        try:
+            recognizer = self._idle.get_nowait()
+        except queue.Empty:
+            recognizer = self._create()
+            if recognizer is None:
+                recognizer = self._idle.get()
+
+        try:
+            yield recognizer
+        finally:
+            self._idle.put(recognizer)
+
+
+class ModelCache:
+    """Loaded recognizer pools, bounded by their approximate resident size.
+
+    Replaces independent lru_caches that counted entries instead of
+    bytes. When the pools together exceed max_bytes, the least recently
+    used ones are dropped. Requests that still hold an instance of a
+    dropped pool finish normally; the memory is freed afterwards.
+
+    There is one pool per model and configuration; a request for more
+    instances than the pool allows grows it instead of loading the model
+    into a second pool.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        repo_id: str,
+        size: int,
+        num_threads: Optional[int],
+        quantization: str,
+    ) -> RecognizerPool:
+        key = (repo_id, num_threads, quantization)
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None:
+                self._pools.move_to_end(key)
+                self.hits += 1
+                pool.grow(size)
+                return pool
+
+            self.misses += 1
+            pool = RecognizerPool(
+                repo_id, size, num_threads, quantization, on_load=self.evict
+            )
+            self._pools[key] = pool
+            return pool
+
+    @property
+    def nbytes(self) -> int:
+        return sum(pool.nbytes for pool in self._pools.values())
+
+    def evict(self) -> None:
+        """Drop least recently used pools until within max_bytes.
+
+        The most recently used pool is always kept.
+        """
+        with self._lock:
+            while len(self._pools) > 1 and self.nbytes > self.max_bytes:
+                key, pool = self._pools.popitem(last=False)
+                self.evictions += 1
+                logging.info(
+                    f"Evicted {key[0]} ({pool.nbytes / 1e6:.1f} MB) from the "
+                    f"model cache. {self.stats()}"
+                )
+
+    def stats(self) -> str:
+        return (
+            f"Model cache: {len(self._pools)} models, "
+            f"{self.nbytes / 1e6:.1f}/{self.max_bytes / 1e6:.1f} MB, "
+            f"{self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+        )
+
+
+model_cache = ModelCache(default_model_cache_bytes)
+
+
+def get_quantization(repo_id: str) -> str:
+    """Quantization variant to load for repo_id.
+
+    An entry for repo_id in SUBTITLES_QUANTIZATION wins over a global
+    entry there, which wins over the default of the catalog. A global
+    entry is ignored for models that do not have that variant.
+    """
+    spec = model_catalog[repo_id]
+    if repo_id in quantization_overrides:
+        return quantization_overrides[repo_id]
+
+    q = quantization_overrides.get("")
+    if q in spec.variants:
+        return q
+    return spec.quantization
+
+
+def get_recognizer_pool(
+    repo_id: str,
+    size: int = default_pool_size,
+    num_threads: Optional[int] = None,
+    quantization: Optional[str] = None,
+) -> RecognizerPool:
+    if repo_id not in model_catalog:
         raise ValueError(f"Unsupported repo_id: {repo_id}")
+    quantization = quantization or get_quantization(repo_id)
+    return model_cache.get(repo_id, size, num_threads, quantization)
 
 
-def _get_wenetspeech_pre_trained_model(repo_id):
-    assert repo_id in (
-        "csukuangfj/sherpa-onnx-conformer-zh-stateless2-2023-05-23",
-    ), repo_id
-
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-        decoding_method="greedy_search",
-    )
-
-    return recognizer
-
-
-def _get_multi_zh_hans_pre_trained_model(repo_id):
-    assert repo_id in ("zrjin/sherpa-onnx-zipformer-multi-zh-hans-2023-9-2",), repo_id
-
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder-epoch-20-avg-1.onnx",
-        subfolder=".",
-    )
-
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder-epoch-20-avg-1.onnx",
-        subfolder=".",
-    )
-
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner-epoch-20-avg-1.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-        decoding_method="greedy_search",
-    )
-
-    return recognizer
-
-
-def _get_english_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert (
-        repo_id
-        == "yfyeung/icefall-asr-multidataset-pruned_transducer_stateless7-2023-05-04"
-    ), repo_id
-
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder-epoch-30-avg-4.onnx",
-        subfolder="exp",
-    )
-
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder-epoch-30-avg-4.onnx",
-        subfolder="exp",
-    )
-
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner-epoch-30-avg-4.onnx",
-        subfolder="exp",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder="lang_bpe_500")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-        decoding_method="greedy_search",
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=10)
-def _get_korean_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in ("k2-fsa/sherpa-onnx-zipformer-korean-2024-06-24",), repo_id
-
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder-epoch-99-avg-1.int8.onnx",
-        subfolder=".",
-    )
-
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=10)
-def _get_japanese_pre_trained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in ("reazon-research/reazonspeech-k2-v2",), repo_id
-
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder-epoch-99-avg-1.int8.onnx",
-        subfolder=".",
-    )
-
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner-epoch-99-avg-1.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=10)
-def _get_yifan_thai_pretrained_model(repo_id: str) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in (
-        "yfyeung/icefall-asr-gigaspeech2-th-zipformer-2024-06-20",
-    ), repo_id
-
-    encoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="encoder-epoch-12-avg-5.int8.onnx",
-        subfolder="exp",
-    )
-
-    decoder_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="decoder-epoch-12-avg-5.onnx",
-        subfolder="exp",
-    )
-
-    joiner_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="joiner-epoch-12-avg-5.int8.onnx",
-        subfolder="exp",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder="data/lang_bpe_2000")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_transducer(
-        tokens=tokens,
-        encoder=encoder_model,
-        decoder=decoder_model,
-        joiner=joiner_model,
-        num_threads=2,
-        sample_rate=16000,
-        feature_dim=80,
-    )
-
-    return recognizer
-
-
-@lru_cache(maxsize=10)
-def _get_sense_voice_pre_trained_model(
+def get_pretrained_model(
     repo_id: str,
-    decoding_method: str,
-    num_active_paths: int,
+    num_threads: Optional[int] = None,
+    quantization: Optional[str] = None,
 ) -> sherpa_onnx.OfflineRecognizer:
-    assert repo_id in [
-        "csukuangfj/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17",
-    ], repo_id
-
-    nn_model = _get_nn_model_filename(
-        repo_id=repo_id,
-        filename="model.int8.onnx",
-        subfolder=".",
-    )
-
-    tokens = _get_token_filename(repo_id=repo_id, subfolder=".")
-
-    recognizer = sherpa_onnx.OfflineRecognizer.from_sense_voice(
-        model=nn_model,
-        tokens=tokens,
-        num_threads=2,
-        sample_rate=sample_rate,
-        feature_dim=80,
-        decoding_method="greedy_search",
-        debug=True,
-        use_itn=True,
-    )
-
-    return recognizer
-
-
-chinese_dialect_models = {
-    "csukuangfj/sherpa-onnx-telespeech-ctc-int8-zh-2024-06-04": _get_chinese_dialect_models,
-}
-
-zh_en_ko_ja_yue_models = {
-    "csukuangfj/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17": _get_sense_voice_pre_trained_model,
-}
-
-chinese_models = {
-    "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28": _get_paraformer_zh_pre_trained_model,
-    "csukuangfj/sherpa-onnx-conformer-zh-stateless2-2023-05-23": _get_wenetspeech_pre_trained_model,  # noqa
-    "zrjin/sherpa-onnx-zipformer-multi-zh-hans-2023-9-2": _get_multi_zh_hans_pre_trained_model,  # noqa
-}
-
-english_models = {
-    "whisper-tiny.en": _get_whisper_model,
-    "whisper-base.en": _get_whisper_model,
-    "whisper-small.en": _get_whisper_model,
-    "whisper-distil-small.en": _get_whisper_model,
-    "whisper-medium.en": _get_whisper_model,
-    "whisper-distil-medium.en": _get_whisper_model,
-    "yfyeung/icefall-asr-multidataset-pruned_transducer_stateless7-2023-05-04": _get_english_model,  # noqa
-}
-
-chinese_english_mixed_models = {
-    "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28": _get_paraformer_zh_pre_trained_model,
-}
-
-korean_models = {
-    "k2-fsa/sherpa-onnx-zipformer-korean-2024-06-24": _get_korean_pre_trained_model,
-}
+    pool = get_recognizer_pool(
+        repo_id, num_threads=num_threads, quantization=quantization
+    )
+    return pool.shared()
+
+
+def preload(
+    repo_ids: List[str],
+    punctuation: bool = True,
+    num_workers: int = 4,
+) -> None:
+    """Load and warm up models before serving requests.
+
+    For each repo_id, one instance of its recognizer pool is created;
+    the others are created on demand, so that preloading many models
+    stays within the ModelCache budget. default_pool_size VAD instances
+    and, if punctuation is True, the punctuation model are created as
+    well. Models are loaded in parallel threads. If the budget is still
+    exceeded, the models unloaded again are reported.
+    """
+
+    def timed(name, fn):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        logging.info(f"Loaded and warmed up {name} in {elapsed:.3f} s")
+
+    tasks = {"vad": lambda: vad_pool.fill(default_pool_size)}
+    if punctuation:
+        tasks["punct"] = lambda: get_punct_model().add_punctuation("hello world")
+    for repo_id in repo_ids:
+        tasks[repo_id] = partial(get_recognizer_pool(repo_id).fill, 1)
+
+    evictions = model_cache.evictions
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(timed, name, fn) for name, fn in tasks.items()]
+        for f in futures:
+            f.result()
+    elapsed = time.perf_counter() - start
+    logging.info(f"Preloaded {len(tasks)} models in {elapsed:.3f} s")
+
+    if model_cache.evictions > evictions:
+        logging.warning(
+            f"{model_cache.evictions - evictions} preloaded models were unloaded "
+            "again as SUBTITLES_MODEL_CACHE_BYTES was exceeded. "
+            f"{model_cache.stats()}"
+        )
 
-russian_models = {
-    "alphacep/vosk-model-ru": _get_russian_pre_trained_model,
-    "alphacep/vosk-model-small-ru": _get_russian_pre_trained_model,
-}
-
-thai_models = {
-    "yfyeung/icefall-asr-gigaspeech2-th-zipformer-2024-06-20": _get_yifan_thai_pretrained_model,
-}
-
-japanese_models = {
-    "reazon-research/reazonspeech-k2-v2": _get_japanese_pre_trained_model
-}
 
 language_to_models = {
-    "超多种中文方言": list(chinese_dialect_models.keys()),
-    "Chinese+English": list(chinese_english_mixed_models.keys()),
-    "Chinese+English+Korean+Japanese+Cantoes(中英韩日粤语)": list(
-        zh_en_ko_ja_yue_models.keys()
-    ),
-    "Chinese": list(chinese_models.keys()),
-    "English": list(english_models.keys()),
-    "Russian": list(russian_models.keys()),
-    "Korean": list(korean_models.keys()),
-    "Thai": list(thai_models.keys()),
-    "Japanese": list(japanese_models.keys()),
+    "超多种中文方言": [
+        "csukuangfj/sherpa-onnx-telespeech-ctc-int8-zh-2024-06-04",
+    ],
+    "Chinese+English": [
+        "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28",
+    ],
+    "Chinese+English+Korean+Japanese+Cantoes(中英韩日粤语)": [
+        "csukuangfj/sherpa-onnx-sense-voice-zh-en-ja-ko-yue-2024-07-17",
+    ],
+    "Chinese": [
+        "csukuangfj/sherpa-onnx-paraformer-zh-2023-03-28",
+        "csukuangfj/sherpa-onnx-conformer-zh-stateless2-2023-05-23",
+        "zrjin/sherpa-onnx-zipformer-multi-zh-hans-2023-9-2",
+    ],
+    "English": [
+        "whisper-tiny.en",
+        "whisper-base.en",
+        "whisper-small.en",
+        "whisper-distil-small.en",
+        "whisper-medium.en",
+        "whisper-distil-medium.en",
+        "yfyeung/icefall-asr-multidataset-pruned_transducer_stateless7-2023-05-04",
+    ],
+    "Russian": [
+        "alphacep/vosk-model-ru",
+        "alphacep/vosk-model-small-ru",
+    ],
+    "Korean": [
+        "k2-fsa/sherpa-onnx-zipformer-korean-2024-06-24",
+    ],
+    "Thai": [
+        "yfyeung/icefall-asr-gigaspeech2-th-zipformer-2024-06-20",
+    ],
+    "Japanese": [
+        "reazon-research/reazonspeech-k2-v2",
+    ],
 }
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+#
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local registry of model files.
+
+The manifest maps every file a model needs on the Hugging Face hub to
+its path on local disk and its sha256. Once it is filled, models are
+loaded without contacting the hub.
+
+Usage:
+
+    # Download all models, the VAD and the punctuation model, and write
+    # ./models/manifest.json
+    python3 registry.py prefetch
+
+    # Only some models
+    python3 registry.py prefetch --repo-id whisper-tiny.en --repo-id vad
+
+    # Check that the files in the manifest exist and match their sha256
+    python3 registry.py verify
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional, Tuple
+
+default_manifest = os.environ.get(
+    "SUBTITLES_MODEL_MANIFEST", "./models/manifest.json"
+)
+
+# Names for the non-ASR models in the manifest and in --repo-id
+vad_name = "vad"
+punct_name = "punct"
+
+
+def file_digest(filename: str, chunk_size: int = 1 << 20) -> str:
+    """sha256 of the bytes of filename."""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+
+class ModelRegistry:
+    """Resolves model files through a local manifest.
+
+    The manifest has two tables: "files" maps "<hub repo>/<subfolder>/
+    <filename>" to the local path, size and sha256 of that file, and
+    "models" maps each repo_id of model.py (plus "vad" and "punct") to
+    the files it is built from.
+    """
+
+    def __init__(self, manifest: str = default_manifest):
+        self.manifest = Path(manifest)
+        self._lock = threading.Lock()
+        self._files = None
+        self._models = {}
+
+        # Per thread: (key, path) of the files resolved inside record(),
+        # and whether prefetch() is refreshing the manifest
+        self._local = threading.local()
+
+    def _load(self) -> None:
+        if self._files is not None:
+            return
+
+        self._files = {}
+        if self.manifest.is_file():
+            with open(self.manifest, encoding="utf-8") as f:
+                data = json.load(f)
+            self._files = data["files"]
+            self._models = data["models"]
+            logging.info(f"Loaded {len(self._files)} files from {self.manifest}")
+
+    def save(self) -> None:
+        self.manifest.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.manifest.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": 1, "files": self._files, "models": self._models},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp, self.manifest)
+
+    def resolve(
+        self,
+        repo_id: str,
+        filename: str,
+        subfolder: str,
+        download: Callable[[], str],
+    ) -> str:
+        """Local path of a file on the hub.
+
+        Files in the manifest are returned without contacting the hub.
+        Otherwise download() fetches the file and returns its path.
+        """
+        key = f"{repo_id}/{subfolder}/{filename}"
+        refresh = getattr(self._local, "refresh", False)
+        with self._lock:
+            self._load()
+            entry = self._files.get(key)
+
+        path = None
+        if entry is not None and not refresh:
+            if Path(entry["path"]).is_file():
+                path = entry["path"]
+            else:
+                logging.warning(f"{entry['path']} from {self.manifest} is missing")
+
+        if path is None:
+            if not refresh:
+                logging.info(f"{key} is not in {self.manifest}; downloading it")
+            path = os.path.abspath(download())
+
+        if refresh:
+            with self._lock:
+                self._files[key] = {
+                    "path": path,
+                    "size": os.path.getsize(path),
+                    "sha256": file_digest(path),
+                }
+
+        recorded = getattr(self._local, "recorded", None)
+        if recorded is not None:
+            recorded.append((key, path))
+
+        return path
+
+    @contextmanager
+    def record(self) -> Iterator[List[Tuple[str, str]]]:
+        """Collect (key, path) of the files resolved by this thread."""
+        self._local.recorded = []
+        try:
+            yield self._local.recorded
+        finally:
+            self._local.recorded = None
+
+    def prefetch(self, name: str, load: Callable[[], object]) -> None:
+        """Run load() and record the files it needs under name."""
+        self._local.refresh = True
+        try:
+            with self.record() as files:
+                load()
+        finally:
+            self._local.refresh = False
+
+        with self._lock:
+            self._models[name] = [key for key, _ in files]
+        self.save()
+        logging.info(f"Prefetched {name}: {len(files)} files")
+
+    def models(self) -> List[str]:
+        """Names of the models recorded in the manifest."""
+        with self._lock:
+            self._load()
+            return sorted(self._models)
+
+    def verify(self) -> List[str]:
+        """Return the keys of missing or corrupted files."""
+        self._load()
+        bad = []
+        for key, entry in sorted(self._files.items()):
+            path = entry["path"]
+            if not Path(path).is_file():
+                logging.error(f"{key}: {path} is missing")
+                bad.append(key)
+            elif file_digest(path) != entry["sha256"]:
+                logging.error(f"{key}: sha256 of {path} does not match")
+                bad.append(key)
+        return bad
+
+
+registry = ModelRegistry()
+
+
+def prefetch(repo_ids: Optional[List[str]] = None) -> List[str]:
+    """Prefetch the given models, or all of them. Returns those that failed."""
+    # Imported here because model.py uses the registry
+    from model import get_model_files, get_punct_model, get_vad, model_catalog
+
+    loaders = {
+        vad_name: get_vad,
+        punct_name: get_punct_model,
+    }
+    for repo_id, spec in model_catalog.items():
+        # every quantization variant, so deployments can choose later
+        loaders[repo_id] = lambda repo_id=repo_id, spec=spec: [
+            get_model_files(repo_id, q) for q in spec.variants
+        ]
+
+    failed = []
+    for name in repo_ids or loaders:
+        if name not in loaders:
+            raise ValueError(f"Unsupported repo_id: {name}")
+        try:
+            registry.prefetch(name, loaders[name])
+        except Exception:
+            logging.exception(f"Failed to prefetch {name}")
+            failed.append(name)
+    return failed
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p = subparsers.add_parser("prefetch", help="Download models into the manifest")
+    p.add_argument(
+        "--repo-id",
+        type=str,
+        action="append",
+        help=f"Model to prefetch; may be repeated. '{vad_name}' and "
+        f"'{punct_name}' select the VAD and the punctuation model. "
+        "Default: all",
+    )
+
+    subparsers.add_parser("verify", help="Check the files of the manifest")
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.command == "prefetch":
+        failed = prefetch(args.repo_id)
+        if failed:
+            raise SystemExit(f"Failed to prefetch: {', '.join(failed)}")
+    elif args.command == "verify":
+        bad = registry.verify()
+        if bad:
+            raise SystemExit(f"{len(bad)} files are missing or corrupted")
+        print("OK")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()
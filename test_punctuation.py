@@ -0,0 +1,141 @@
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tests of the windowed punctuation helpers in decode.py.
+
+Usage:
+
+    python3 -m unittest test_punctuation
+"""
+
+import unittest
+
+from decode import Segment, _punct_windows, _split_punctuated, join_texts
+
+
+class SplitPunctuatedTest(unittest.TestCase):
+    def test_inserted_punctuation(self):
+        self.assertEqual(
+            _split_punctuated(
+                "Hello, world. How are you?", ["hello world", "how are you"]
+            ),
+            ["Hello, world.", "How are you?"],
+        )
+
+    def test_dropped_trailing_punctuation(self):
+        self.assertEqual(
+            _split_punctuated(
+                "Hello world. How are you", ["hello world.", "how are you?"]
+            ),
+            ["Hello world.", "How are you"],
+        )
+
+    def test_changed_trailing_punctuation(self):
+        self.assertEqual(
+            _split_punctuated(
+                "Hello world. How are you!", ["hello world.", "how are you?"]
+            ),
+            ["Hello world.", "How are you!"],
+        )
+
+    def test_dropped_context(self):
+        self.assertEqual(
+            _split_punctuated(
+                "Hello world, how are?", ["hello world", "how are", "you"]
+            ),
+            ["Hello world,", "how are?", "you"],
+        )
+
+    def test_changed_last_text(self):
+        # once its first character matched, the rest goes to the last text
+        self.assertEqual(
+            _split_punctuated(
+                "Hello world, how are? Yes", ["hello world", "how are", "you"]
+            ),
+            ["Hello world,", "how are?", "Yes"],
+        )
+
+    def test_replaced_last_text(self):
+        # none of it matched: the new words cannot be placed
+        self.assertIsNone(_split_punctuated("Hello xyz.", ["hello", "world"]))
+
+    def test_mismatch_before_last_text(self):
+        self.assertIsNone(_split_punctuated("Foo bar.", ["hello", "world"]))
+
+    def test_cjk(self):
+        self.assertEqual(
+            _split_punctuated("今天天气很好，我们去公园。", ["今天天气很好", "我们去公园"]),
+            ["今天天气很好，", "我们去公园。"],
+        )
+
+    def test_empty_text_in_the_middle(self):
+        texts = ["hello", "", "world"]
+        self.assertEqual(join_texts(texts), "hello world")
+        self.assertEqual(
+            _split_punctuated("Hello, world.", texts), ["Hello,", "", "world."]
+        )
+
+    def test_text_without_characters_keeps_its_input(self):
+        self.assertEqual(_split_punctuated("Hello.", ["hello", "uh"]), ["Hello.", "uh"])
+
+
+class PunctWindowsTest(unittest.TestCase):
+    def windows(self, texts, window_chars, context_chars):
+        segments = [Segment(i, 1, text) for i, text in enumerate(texts)]
+        return [
+            ([seg.text for seg in window], context)
+            for window, context in _punct_windows(segments, window_chars, context_chars)
+        ]
+
+    def test_no_segments(self):
+        self.assertEqual(self.windows([], 10, 8), [])
+
+    def test_windows_and_context(self):
+        texts = [f"w{i:02d} x" for i in range(6)]
+        self.assertEqual(
+            self.windows(texts, 10, 8),
+            [
+                (["w00 x", "w01 x"], "w02 x"),
+                (["w02 x", "w03 x"], "w04 x"),
+                (["w04 x", "w05 x"], ""),
+            ],
+        )
+
+    def test_every_segment_once_in_order(self):
+        texts = [f"segment {i}" for i in range(100)]
+        windows = self.windows(texts, 50, 20)
+        self.assertEqual([t for window, _ in windows for t in window], texts)
+        for window, _ in windows[:-1]:
+            self.assertGreaterEqual(len("".join(window)), 50)
+
+    def test_context_does_not_end_in_a_word(self):
+        texts = ["one two", "three four five", "six"]
+        (first, context), *_ = self.windows(texts, 5, 12)
+        self.assertEqual(first, ["one two"])
+        self.assertEqual(context, "three four")
+
+    def test_cjk_context(self):
+        texts = ["今天天气很好"] * 4
+        self.assertEqual(
+            self.windows(texts, 10, 8),
+            [
+                (["今天天气很好", "今天天气很好"], "今天天气很好"),
+                (["今天天气很好", "今天天气很好"], ""),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+#
+# See LICENSE for clarification regarding multiple authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Generate subtitles for many files without the Gradio app.
+
+Usage:
+
+    # All media files in a directory, recursively; writes foo.srt next
+    # to each foo.mp4
+    python3 transcribe.py --repo-id whisper-tiny.en ./videos
+
+    # Files listed one per line, 4 at a time, with the SRT files in ./srt
+    find /data -name '*.wav' > list.txt
+    python3 transcribe.py --repo-id whisper-tiny.en --num-workers 4 \\
+        --output-dir ./srt --file-list list.txt
+
+    # One long file, split at quiet points into ranges decoded by 8
+    # processes
+    python3 transcribe.py --repo-id whisper-tiny.en --num-processes 8 \\
+        ./lecture.mp4
+
+    # WebVTT instead of SRT; writes foo.vtt
+    python3 transcribe.py --repo-id whisper-tiny.en --format vtt ./videos
+
+Files whose .srt (or .vtt) is newer than the input are skipped unless --force is
+given. Progress on each file is saved to foo.srt.checkpoint while it is
+decoded; if the run is interrupted, the next one continues from there.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from cache import PcmCache
+from decode import (
+    Checkpoint,
+    StageTimes,
+    decode,
+    decode_parallel,
+    default_checkpoint_interval,
+    new_process_pool,
+    subtitle_formats,
+)
+from model import (
+    default_pool_size,
+    get_punct_worker,
+    get_quantization,
+    get_recognizer_pool,
+    model_catalog,
+    sample_rate,
+    supports_punctuation,
+    vad_pool,
+)
+from registry import file_digest
+
+default_extensions = (
+    ".mp4,.mkv,.mov,.avi,.webm,.flv,.wav,.mp3,.m4a,.aac,.flac,.ogg,.opus"
+)
+
+
+def find_files(paths: List[str], extensions: List[str]) -> List[Path]:
+    """Files in paths; directories are searched recursively by extension."""
+    files = []
+    for p in map(Path, paths):
+        if p.is_dir():
+            files.extend(
+                sorted(
+                    f
+                    for f in p.rglob("*")
+                    if f.is_file() and f.suffix.lower() in extensions
+                )
+            )
+        else:
+            files.append(p)
+    return files
+
+
+def srt_filename(
+    filename: Path, output_dir: Optional[str], subtitle_format: str = "srt"
+) -> Path:
+    if output_dir is None:
+        return filename.with_suffix(f".{subtitle_format}")
+    return Path(output_dir) / f"{filename.stem}.{subtitle_format}"
+
+
+def is_up_to_date(filename: Path, srt: Path) -> bool:
+    try:
+        return srt.stat().st_mtime >= filename.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+def checkpoint_key(repo_id: str, filename: Path) -> str:
+    """Changes when the input or the model does."""
+    st = filename.stat()
+    return f"{repo_id}:{get_quantization(repo_id)}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def transcribe(
+    repo_id: str,
+    filename: Path,
+    srt: Path,
+    punctuation: bool,
+    num_asr_workers: int,
+    num_workers: int,
+    checkpoint_interval: float = default_checkpoint_interval,
+    process_pool: Optional[ProcessPoolExecutor] = None,
+    num_processes: int = 1,
+    pcm_cache: Optional[PcmCache] = None,
+    subtitle_format: str = "srt",
+) -> StageTimes:
+    """Decode filename with a pooled recognizer and write srt, which is in
+    subtitle_format, SRT or WebVTT.
+
+    Unless checkpoint_interval is 0, progress is saved next to srt and
+    resumed from, see decode.Checkpoint. With a process_pool, time ranges
+    of filename are decoded by num_processes of its processes instead,
+    see decode.decode_parallel(); there are no checkpoints then.
+    Otherwise, with a pcm_cache, ffmpeg output is read from and saved to
+    it.
+    """
+    times = StageTimes()
+    punct = get_punct_worker() if punctuation else None
+
+    checkpoint = None
+    if process_pool is not None:
+        start = time.perf_counter()
+        result, _ = decode_parallel(
+            repo_id,
+            punct,
+            str(filename),
+            num_processes,
+            executor=process_pool,
+            times=times,
+            subtitle_format=subtitle_format,
+        )
+        elapsed = time.perf_counter() - start
+    else:
+        if checkpoint_interval > 0:
+            srt.parent.mkdir(parents=True, exist_ok=True)
+            checkpoint = Checkpoint(
+                f"{srt}.checkpoint",
+                checkpoint_key(repo_id, filename),
+                interval=checkpoint_interval,
+            )
+            checkpoint.load()
+
+        pcm = None
+        if pcm_cache is not None:
+            start = time.perf_counter()
+            pcm = pcm_cache.load(pcm_cache.key(file_digest(filename)), str(filename))
+            times.read += time.perf_counter() - start
+
+        with get_recognizer_pool(repo_id, num_workers).acquire() as recognizer:
+            with vad_pool.acquire() as vad:
+                start = time.perf_counter()
+                result, _ = decode(
+                    recognizer,
+                    vad,
+                    punct,
+                    str(filename),
+                    num_asr_workers=num_asr_workers,
+                    pcm=pcm,
+                    times=times,
+                    checkpoint=checkpoint,
+                    subtitle_format=subtitle_format,
+                )
+                elapsed = time.perf_counter() - start
+
+    # Written to a temporary file first, so an interrupted run does not
+    # leave an SRT file that looks up to date
+    srt.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=srt.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(result)
+        os.replace(tmp, srt)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    audio_seconds = times.num_samples / sample_rate
+    logging.info(
+        f"{filename}: {audio_seconds:.2f} s of audio in {elapsed:.2f} s, "
+        f"RTF {elapsed / max(audio_seconds, 1e-9):.4f}"
+    )
+    return times
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--repo-id", type=str, required=True)
+    parser.add_argument(
+        "--num-workers",
+        type=int,
+        default=default_pool_size,
+        help="Files decoded concurrently, each with its own recognizer instance",
+    )
+    parser.add_argument(
+        "--num-asr-workers",
+        type=int,
+        default=1,
+        help="Threads decoding batches of one file",
+    )
+    parser.add_argument(
+        "--num-processes",
+        type=int,
+        default=1,
+        help="Split each file at quiet points into time ranges decoded by this "
+        "many worker processes, each with its own recognizer. Disables "
+        "checkpoints",
+    )
+    parser.add_argument(
+        "--punctuation",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Add punctuation, for models that need it",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=str,
+        help="Where to write the SRT files. Default: next to each input",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=subtitle_formats,
+        default="srt",
+        help="Subtitle format to write",
+    )
+    parser.add_argument(
+        "--extensions",
+        type=str,
+        default=default_extensions,
+        help="Comma-separated file extensions searched for in directories",
+    )
+    parser.add_argument(
+        "--file-list",
+        type=str,
+        help="File with one input per line; '-' for stdin",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Decode files even if their SRT file is up to date",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=float,
+        default=default_checkpoint_interval,
+        help="Save progress after every this many seconds of input, so an "
+        "interrupted run resumes where it stopped. 0 disables checkpoints",
+    )
+    parser.add_argument(
+        "--pcm-cache",
+        action="store_true",
+        help="Keep the decoded audio of each file in the cache directory, so "
+        "decoding it again, e.g., with another model, does not run ffmpeg. "
+        "Not used with --num-processes",
+    )
+    parser.add_argument(
+        "--summary",
+        type=str,
+        help="Also write the summary as JSON to this file",
+    )
+    parser.add_argument("paths", type=str, nargs="*", help="Files or directories")
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.repo_id not in model_catalog:
+        raise SystemExit(f"Unsupported repo_id: {args.repo_id}")
+
+    paths = list(args.paths)
+    if args.file_list:
+        f = sys.stdin if args.file_list == "-" else open(args.file_list)
+        with f:
+            paths.extend(line.strip() for line in f if line.strip())
+
+    extensions = [e.strip().lower() for e in args.extensions.split(",")]
+    files = find_files(paths, extensions)
+    if not files:
+        raise SystemExit("No input files")
+
+    todo = []
+    skipped = 0
+    seen = {}
+    for filename in files:
+        srt = srt_filename(filename, args.output_dir, args.format)
+        if srt in seen:
+            raise SystemExit(f"{seen[srt]} and {filename} would both write {srt}")
+        seen[srt] = filename
+
+        if not args.force and is_up_to_date(filename, srt):
+            skipped += 1
+        else:
+            todo.append((filename, srt))
+    logging.info(
+        f"{len(files)} files: {len(todo)} to decode, {skipped} up to date"
+    )
+
+    punctuation = args.punctuation and supports_punctuation(args.repo_id)
+
+    start = time.perf_counter()
+    audio_seconds = 0.0
+    failed = []
+    with ExitStack() as stack:
+        process_pool = None
+        if args.num_processes > 1:
+            # shared by all files, so each process loads the model once
+            process_pool = stack.enter_context(new_process_pool(args.num_processes))
+        pcm_cache = PcmCache() if args.pcm_cache else None
+        executor = stack.enter_context(
+            ThreadPoolExecutor(max_workers=args.num_workers)
+        )
+        futures = {
+            executor.submit(
+                transcribe,
+                args.repo_id,
+                filename,
+                srt,
+                punctuation,
+                args.num_asr_workers,
+                args.num_workers,
+                args.checkpoint_interval,
+                process_pool,
+                args.num_processes,
+                pcm_cache,
+                args.format,
+            ): filename
+            for filename, srt in todo
+        }
+        for f, filename in futures.items():
+            try:
+                audio_seconds += f.result().num_samples / sample_rate
+            except Exception:
+                logging.exception(f"Failed to decode {filename}")
+                failed.append(str(filename))
+    elapsed = time.perf_counter() - start
+
+    summary = {
+        "repo_id": args.repo_id,
+        "num_files": len(files),
+        "num_decoded": len(todo) - len(failed),
+        "num_skipped": skipped,
+        "num_failed": len(failed),
+        "failed": failed,
+        "num_workers": args.num_workers,
+        "num_processes": args.num_processes,
+        "wall_seconds": elapsed,
+        "audio_seconds": audio_seconds,
+        "rtf": elapsed / audio_seconds if audio_seconds else 0.0,
+        "audio_hours_per_hour": audio_seconds / elapsed if elapsed else 0.0,
+    }
+    print(
+        f"Decoded {summary['num_decoded']} files "
+        f"({audio_seconds / 3600:.2f} h of audio) in {elapsed:.1f} s: "
+        f"RTF {summary['rtf']:.4f}, "
+        f"{summary['audio_hours_per_hour']:.1f} h of audio per hour. "
+        f"Skipped {skipped}, failed {len(failed)}"
+    )
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+            f.write("\n")
+
+    if failed:
+        raise SystemExit(f"Failed to decode {len(failed)} files")
+
+
+if __name__ == "__main__":
+    formatter = "%(asctime)s %(levelname)s [%(filename)s:%(lineno)d] %(message)s"
+
+    logging.basicConfig(format=formatter, level=logging.INFO)
+
+    main()